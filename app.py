@@ -1,10 +1,14 @@
+import csv
+import hmac
+import io
+import itertools
 import logging
 import re
+import threading
 import time
-from random import randrange
 from urllib.parse import urlparse
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from yaml import load
 
 try:
@@ -12,71 +16,52 @@ try:
 except ImportError:
     from yaml import Loader
 
-from datetime import datetime, timedelta
+from datetime import datetime
 import json
 import os
 from typing import List
-from flask import Flask, request, render_template, redirect, url_for, flash
+from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, Response, stream_with_context
 import flask_login
 import requests
-from flask_rq2 import RQ
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import func, or_
+
+import core
+from core import (ACTIVE_CAMPAIGNS_KEY, HISTOGRAM_BUCKETS, METRIC_TYPES, METRICS_KEY, WA_SESSIONS, Campaign, GroupLink,
+                  Message, MessageStep, campaign_progress, db, ensure_schema, queue_campaign, queue_stats, rq,
+                  wa_sessions)
 
-LOG_FORMAT = ' - %(message)s'
-logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
 app.secret_key = os.environ.get('APP_SECRET_KEY', "SECRET-KEY-HERE")
 
-# rq configs
-app.config['RQ_REDIS_URL'] = os.environ.get('RQ_REDIS_URL', 'redis://localhost:6379/0')
-rq = RQ()
-rq.init_app(app)
-
-# db configs
-db = SQLAlchemy()
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SQLALCHEMY_DATABASE_URI', "sqlite:///wa.db")
-db.init_app(app)
-
-
-class GroupLink(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    link = db.Column(db.String(150), unique=True, nullable=False)
-    active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime(timezone=True), default=datetime.now())
-    chat_id = db.Column(db.String(100), default=None)
-    name = db.Column(db.String(250), default=None)
-
-
-class Campaign(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(200), nullable=False)
-    message = db.Column(db.Text, nullable=False)
-    has_run = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime(timezone=True), default=datetime.now())
-    started_at = db.Column(db.DateTime(timezone=True))
-    finished_at = db.Column(db.DateTime(timezone=True))
-    active = db.Column(db.Boolean, default=True)
-
-
-class Message(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    campaign_id = db.Column(db.Integer, db.ForeignKey(
-        'campaign.id'), nullable=False)
-    group_link = db.Column(db.Integer, db.ForeignKey(
-        'group_link.id'), nullable=False)
-    sent_at = db.Column(db.DateTime(timezone=True), default=datetime.now())
-    join_succeeded = db.Column(db.Boolean)
-    message_send_succeeded = db.Column(db.Boolean)
-    response_dump = db.Column(db.Text)
-    updated = db.Column(db.DateTime(timezone=True), onupdate=datetime.now())
+core.init_app(app)
+
+# dashboard: how often the open-wa api is probed in the background, and how long the totals are cached
+API_HEALTH_INTERVAL = float(os.environ.get('API_HEALTH_INTERVAL', 15))
+API_HEALTH_TIMEOUT = float(os.environ.get('API_HEALTH_TIMEOUT', 3))
+DASHBOARD_STATS_TTL = float(os.environ.get('DASHBOARD_STATS_TTL', 10))
+
+# rows per page on the links and campaigns listings, ?per_page= can ask for up to MAX_PAGE_SIZE
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+# rows fetched per round trip when a campaign's results are exported
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
 
+# how many links are written per insert statement when saving pasted or uploaded links
+LINK_INGEST_CHUNK_SIZE = int(os.environ.get('LINK_INGEST_CHUNK_SIZE', 500))
+
+# scrapers send `Authorization: Bearer <METRICS_TOKEN>` for /metrics. without a token it needs a login like every page
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 with app.app_context():
-    db.create_all()
+    ensure_schema()
+
+
+@app.before_request
+def check_schema():
+    ensure_schema()
 
 
 # ------------------------- helper functions --------------------------
@@ -92,6 +77,85 @@ def get_tld(link):
     return '{uri.scheme}://{uri.netloc}/'.format(uri=parsed_uri)
 
 
+def keyset_page(model, query, search_columns) -> tuple:
+    """
+    newest first page of `query`, driven by the request args: ?after=<id> continues below that id, ?q= searches
+    search_columns and ?per_page= sets the page size. returns (rows, id to pass as ?after= for the next page or None)
+    """
+    after = request.args.get('after', type=int)
+    per_page = max(1, min(request.args.get('per_page', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    search = request.args.get('q', '').strip()
+    if search:
+        query = query.where(or_(*(column.ilike(f'%{search}%') for column in search_columns)))
+    if after:
+        query = query.where(model.id < after)
+    rows = db.session.execute(query.order_by(model.id.desc()).limit(per_page + 1)).scalars().all()
+    next_after = rows[per_page - 1].id if len(rows) > per_page else None
+    return rows[:per_page], next_after
+
+
+def extract_group_links(lines):
+    # yields the whatsapp group links found in an iterable of text lines, without holding the whole text in memory
+    for line in lines:
+        for link in find_links(line):
+            if get_tld(link) == 'https://chat.whatsapp.com/':
+                yield link
+
+
+def ingest_links(links_iter) -> dict:
+    # dedups in memory and saves the links in chunks, one insert-or-reactivate statement per chunk
+    counts = {'new': 0, 'reactivated': 0, 'duplicates': 0}
+    seen = set()
+    chunk = []
+    for link in links_iter:
+        if link in seen:
+            counts['duplicates'] += 1
+            continue
+        seen.add(link)
+        chunk.append(link)
+        if len(chunk) >= LINK_INGEST_CHUNK_SIZE:
+            save_link_chunk(chunk, counts)
+            chunk = []
+    if chunk:
+        save_link_chunk(chunk, counts)
+    return counts
+
+
+def save_link_chunk(chunk: List[str], counts: dict):
+    existing = {link: (active, quarantined_at) for link, active, quarantined_at in db.session.execute(
+        db.select(GroupLink.link, GroupLink.active, GroupLink.quarantined_at).where(GroupLink.link.in_(chunk)))}
+    for link in chunk:
+        if link not in existing:
+            counts['new'] += 1
+        elif existing[link][0] is False or existing[link][1] is not None:
+            counts['reactivated'] += 1
+        else:
+            counts['duplicates'] += 1
+
+    now = datetime.now()
+    rows = [{'link': link, 'active': True, 'created_at': now} for link in chunk]
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(GroupLink).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=['link'], set_={'active': True}))
+    elif dialect == 'mysql':
+        stmt = mysql.insert(GroupLink).values(rows)
+        db.session.execute(stmt.on_duplicate_key_update(active=True))
+    else:
+        new_rows = [row for row in rows if row['link'] not in existing]
+        if new_rows:
+            db.session.execute(db.insert(GroupLink).values(new_rows))
+        db.session.execute(
+            db.update(GroupLink).where(GroupLink.link.in_(chunk), GroupLink.active.is_(False)).values(active=True))
+    # saving a quarantined link again gives it a fresh start
+    if any(quarantined_at is not None for _, quarantined_at in existing.values()):
+        db.session.execute(db.update(GroupLink).where(
+            GroupLink.link.in_(chunk), GroupLink.quarantined_at.isnot(None)
+        ).values(quarantined_at=None, failure_count=0, next_attempt_at=None))
+    db.session.commit()
+
+
 # ------------------------- auth -------------------------
 login_manager = flask_login.LoginManager()
 login_manager.init_app(app)
@@ -161,57 +225,106 @@ def logout():
 
 # ----------------------------- endpoints -----------------------------
 
+class ApiHealthProbe:
+    """
+    checks the open-wa api from a daemon thread every API_HEALTH_INTERVAL seconds. page loads only read the last
+    result, so a slow or down api never blocks a request. a result older than three intervals counts as down
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = False
+        self.checked_at = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def is_up(self) -> bool:
+        self.start()
+        return self.healthy and time.monotonic() - self.checked_at < 3 * API_HEALTH_INTERVAL
+
+    def start(self):
+        if not self.url:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='api-health-probe', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(API_HEALTH_INTERVAL)
+
+    def check(self):
+        try:
+            r = requests.get(self.url, allow_redirects=False, timeout=API_HEALTH_TIMEOUT)
+            self.healthy = r.status_code == 200
+        except requests.RequestException:
+            self.healthy = False
+        self.checked_at = time.monotonic()
+
+
+api_health = ApiHealthProbe(WA_SESSIONS[0]['url'])
+_dashboard_summary = {'summary': None, 'at': 0}
+
+
+def dashboard_summary() -> dict:
+    # all three totals in one query, cached for DASHBOARD_STATS_TTL seconds
+    if _dashboard_summary['summary'] is None or time.monotonic() - _dashboard_summary['at'] > DASHBOARD_STATS_TTL:
+        groups, campaign_count, messages = db.session.execute(db.select(
+            db.select(func.count(GroupLink.id)).scalar_subquery(),
+            db.select(func.count(Campaign.id)).scalar_subquery(),
+            db.select(func.count(Message.id)).scalar_subquery())).one()
+        _dashboard_summary['summary'] = {
+            'groups': groups,
+            'campaigns': campaign_count,
+            'messages': messages
+        }
+        _dashboard_summary['at'] = time.monotonic()
+    return _dashboard_summary['summary']
+
+
 @app.route('/dashboard', methods=['GET'])
 @flask_login.login_required
 def dashboard():
     # this iframe is the url of the api. once authenticated, the api could redirect to docs page,
-    iframe = os.environ.get('API_BASE_URL')
-    r = requests.get(iframe, allow_redirects=False)
-    if r.status_code == 200:
+    iframe = WA_SESSIONS[0]['url']
+    if api_health.is_up():
         return render_template('app/dashboard.html', iframe=iframe)
-    else:
-        groups = db.session.query(func.count(GroupLink.id))
-        campaign_list = db.session.query(func.count(Campaign.id))
-        messages = db.session.query(func.count(Message.id))
-        summary = {
-            'groups': groups.one()[0],
-            'campaigns': campaign_list.one()[0],
-            'messages': messages.one()[0]
-        }
-    return render_template('app/dashboard.html', summary=summary)
+    return render_template('app/dashboard.html', summary=dashboard_summary())
 
 
 @app.route('/links', methods=['GET', 'POST'])
 @flask_login.login_required
 def links():
     if request.method == 'POST':
-        group_link = request.form['link']
-        links_ = [x for x in find_links(group_link) if get_tld(x) == 'https://chat.whatsapp.com/']
-        added = 0
-        if len(links_) > 0:
-            for item in links_:
-                link = GroupLink(link=item)
-                db.session.add(link)
-                try:
-                    db.session.commit()
-                    added += 1
-                except IntegrityError:
-                    db.session.rollback()
-                    available_link = db.session.execute(db.select(GroupLink).filter_by(link=item)).scalars().one()
-                    if not available_link.active:
-                        available_link.active = True
-                        db.session.add(available_link)
-                        db.session.commit()
-
-        if added > 0:
-            flash(f'{added} new link{"" if len(links_) == 1 else "s"} saved successfully')
+        lines = request.form.get('link', '').splitlines()
+        upload = request.files.get('file')
+        if upload and upload.filename:
+            # .txt / .csv uploads are read line by line, links can sit in any column
+            lines = itertools.chain(lines, (raw.decode('utf-8', 'replace') for raw in upload.stream))
+        counts = ingest_links(extract_group_links(lines))
+        if request.args.get('format') == 'json':
+            return jsonify(counts)
+
+        if counts['new'] > 0 or counts['reactivated'] > 0:
+            flash(f'{counts["new"]} new, {counts["reactivated"]} reactivated and {counts["duplicates"]} duplicate '
+                  f'links saved successfully')
         else:
             flash(f'No new links were found in the message')
         return redirect(url_for('links'))
 
-    links_list = db.session.execute(
-        db.select(GroupLink).filter_by(active=True).order_by(GroupLink.id.desc())).scalars()
-    return render_template('app/links.html', links=links_list)
+    links_list, next_after = keyset_page(
+        GroupLink, db.select(GroupLink).filter_by(active=True), (GroupLink.link, GroupLink.name))
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'links': [{'id': link.id, 'link': link.link, 'name': link.name, 'chat_id': link.chat_id,
+                       'active': link.active, 'created_at': link.created_at, 'failure_count': link.failure_count,
+                       'next_attempt_at': link.next_attempt_at, 'quarantined_at': link.quarantined_at}
+                      for link in links_list],
+            'next_after': next_after
+        })
+    return render_template('app/links.html', links=links_list, next_after=next_after)
 
 
 @app.route('/campaigns', methods=['GET', 'POST'])
@@ -226,330 +339,119 @@ def campaigns():
         flash(f'Campaign [{campaign.title}] created successfully')
         return redirect(url_for('campaigns'))
 
-    campaign_list = db.session.execute(
-        db.select(Campaign).filter_by(active=True).order_by(Campaign.id.desc())).scalars()
-    return render_template('app/campaigns.html', campaigns=campaign_list)
-
-
-class Whatsapp:
-    def __init__(self, url):
-        logger.info(f"BASE URL : {url}")
-        self.base_url = url
-
-    def send_request(self, endpoint: str, data: dict, method='POST'):
-
-        headers = {
-            'accept': "*/*",
-            "Content-Type": "application/json"
-        }
-        try:
-            ln = f'{self.base_url}{endpoint}'
-            logger.info(f" requesting {ln}...")
-
-            r = requests.request(method, ln, headers=headers, json=data)
-        except Exception:
-            raise
-        logger.info(f" PATH : {endpoint} :: RAW RESPONSE :::>>::: ({r.text})")
-        return r.status_code, json.loads(r.text)
-
-    def send_text(self, chat_id: str, message: str):
-
-        payload = {
-            'args': {
-                'to': chat_id,
-                'content': message
-            }
-        }
-        logger.info(f" payload : {payload}")
-        return self.send_request(method='POST', endpoint='/sendText', data=payload)
-
-    def join_group(self, link: str):
-
-        payload = {
-            'args': {
-                'link': link,
-                'returnChatObj': 'true'
-            }
-        }
-
-        logger.info(f" payload : {payload}")
-        return self.send_request(method='POST', endpoint='/joinGroupViaLink', data=payload)
-
-    def leave_group(self, chat_id: str):
-
-        payload = {
-            "args": {
-                "groupId": chat_id
-            }
-        }
-
-        logger.info(f" payload : {payload}")
-        return self.send_request(method='POST', endpoint='/leaveGroup', data=payload)
-
-
-@rq.job
-def join_group(group_link: GroupLink, message: Message, text: str, **kwargs):
-    whatsapp = Whatsapp(os.environ.get('API_BASE_URL'))
-    logger.info(f" processing join group for {group_link.link}")
-    with app.app_context():
-        logger.info("joining group")
-        code, join_resp = whatsapp.join_group(group_link.link)
-        if code == 200 and join_resp["success"] and isinstance(join_resp['response'], dict):
-            group_chat_id: str = join_resp["response"].get('id')
-            group_name: str = join_resp["response"].get('name')
-            logger.info(f" successfully joined group with id: {group_chat_id}")
-            if group_chat_id:
-                message.join_succeeded = True
-                message.response_dump = json.dumps(join_resp)
-                group_link.chat_id = group_chat_id
-                group_link.name = group_name
-                db.session.add(group_link)
-                db.session.add(message)
-                db.session.commit()
-                db.session.refresh(group_link)
-
-                db.session.refresh(group_link)
-                db.session.refresh(message)
-
-                # schedule sending message
-                secs = randrange(5, 15)
-                send_msg_to_group.schedule(
-                    timedelta(seconds=secs),
-                    whatsapp=whatsapp,
-                    group_link=group_link,
-                    text=text,
-                    message=message)
-                logger.info(f" ⏲ scheduled sending message to {group_link.name} for {secs}")
-            else:
-                group_link.chat_id = None
-                message.response_dump = json.dumps(join_resp)
-                db.session.add(group_link)
-                db.session.add(message)
-                db.session.commit()
+    campaign_list, next_after = keyset_page(
+        Campaign, db.select(Campaign).filter_by(active=True), (Campaign.title, Campaign.message))
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'campaigns': [{'id': campaign.id, 'title': campaign.title, 'has_run': campaign.has_run,
+                           'created_at': campaign.created_at, 'started_at': campaign.started_at,
+                           'finished_at': campaign.finished_at} for campaign in campaign_list],
+            'next_after': next_after
+        })
+    return render_template('app/campaigns.html', campaigns=campaign_list, next_after=next_after)
+
+
+# ------------------------- metrics -------------------------
+def render_metrics() -> str:
+    samples = dict(sorted((k.decode(), v.decode()) for k, v in rq.connection.hgetall(METRICS_KEY).items()))
+    lines = []
+    for metric, kind in METRIC_TYPES.items():
+        lines.append(f'# TYPE {metric} {kind}')
+        if kind == 'histogram':
+            lines.extend(render_histogram(metric, HISTOGRAM_BUCKETS[metric], samples))
         else:
-            message.join_succeeded = False
-            message.response_dump = json.dumps(join_resp)
-            group_link.chat_id = None
-            db.session.add(group_link)
-            db.session.add(message)
-            db.session.commit()
-
-
-@rq.job
-def send_msg_to_group(group_link: GroupLink, text: str, message: Message, **kwargs):
-    whatsapp = Whatsapp(os.environ.get('API_BASE_URL'))
-    with app.app_context():
-        logger.info(f" processing send message for {group_link.link} ")
-        if group_link.chat_id is not None and message.join_succeeded:
-            logger.info(f" sending message to {group_link.name}...")
-            send_code, send_resp = whatsapp.send_text(
-                chat_id=group_link.chat_id, message=text)
-            if send_code == 200 and send_resp['response']:
-                message.message_send_succeeded = True
-                message.response_dump = json.dumps(send_resp)
-                db.session.add(group_link)
-                db.session.add(message)
-                db.session.commit()
-                logger.info("successfully sent message to group")
-
-                db.session.refresh(group_link)
-                db.session.refresh(message)
-
-                secs = randrange(1, 10)
-                leave_group.schedule(
-                    timedelta(seconds=secs),
-                    whatsapp=whatsapp,
-                    group_link=group_link,
-                    message=text)
-
-                logger.info(f" ⏲ scheduled leaving group for {secs}")
-            else:
-                message.message_send_succeeded = False
-                message.response_dump = json.dumps(send_resp)
-                db.session.add(group_link)
-                db.session.add(message)
-                db.session.commit()
-                logger.info("Message sending did not succeed")
-
-
-@rq.job
-def leave_group(group_link: GroupLink, message: Message, **kwargs):
-    whatsapp = Whatsapp(os.environ.get('API_BASE_URL'))
-    with app.app_context():
-        logger.info(f" processing leave group for {group_link.link} ")
-        exit_code, exit_resp = whatsapp.leave_group(
-            chat_id=group_link.chat_id)
-        if exit_code == 200:
-            logger.info(f"[LEFT GROUP] {exit_resp}")
-        message.response_dump = json.dumps(exit_resp)
-        db.session.commit()
-
-
-@rq.job
-def campaign_task(links_list: List[GroupLink], message: str, campaign_id, **kwargs):
+            lines.extend(f'{name} {value}' for name, value in samples.items() if name.startswith(metric + '{'))
+    stats = queue_stats()
+    for metric, field in (('rq_queue_depth', 'depth'), ('rq_queue_oldest_wait_seconds', 'oldest_wait_seconds'),
+                          ('rq_queue_workers', 'workers')):
+        lines.append(f'# TYPE {metric} gauge')
+        lines.extend(f'{metric}{{queue="{queue["queue"]}"}} {queue[field]}' for queue in stats)
+    lines.append('# TYPE wa_session_scale gauge')
+    lines.extend(f'wa_session_scale{{session="{wa_session.name}"}} {wa_session.health.scale()}'
+                 for wa_session in wa_sessions)
+    lines.append('# TYPE wa_session_circuit_open gauge')
+    lines.extend(f'wa_session_circuit_open{{session="{wa_session.name}"}} {int(wa_session.health.open_for() > 0)}'
+                 for wa_session in wa_sessions)
+    lines.append('# TYPE campaign_groups gauge')
+    for campaign_id in sorted(int(campaign_id) for campaign_id in rq.connection.smembers(ACTIVE_CAMPAIGNS_KEY)):
+        progress = campaign_progress(campaign_id)
+        if not progress:
+            continue
+        for state in ('queued', 'joined', 'sent', 'failed'):
+            lines.append(f'campaign_groups{{campaign="{campaign_id}",state="{state}"}} {progress[state]}')
+    return '\n'.join(lines) + '\n'
+
+
+def render_histogram(metric: str, buckets: tuple, samples: dict) -> List[str]:
+    # workers only write the buckets a call fell into. prometheus wants every bucket of a series, in order, +Inf last
+    lines = []
+    count_prefix = f'{metric}_count{{'
+    for count_name in (name for name in samples if name.startswith(count_prefix)):
+        labels = count_name[len(count_prefix):-1]
+        for bound in buckets + ('+Inf',):
+            bucket = f'{metric}_bucket{{{labels},le="{bound}"}}'
+            lines.append(f'{bucket} {samples.get(bucket, 0)}')
+        lines.append(f'{metric}_sum{{{labels}}} {samples.get(f"{metric}_sum{{{labels}}}", 0)}')
+        lines.append(f'{count_name} {samples[count_name]}')
+    return lines
+
+
+# ------------------------- export -------------------------
+EXPORT_COLUMNS = ('message_id', 'link_id', 'link', 'name', 'chat_id', 'wa_session', 'join_succeeded',
+                  'message_send_succeeded', 'error', 'sent_at', 'updated')
+
+
+def export_rows(campaign_id):
     """
-    sample success response:
-
-    {
-        "success": true,
-        "response": {
-            "id": "120363042118385076@g.us",
-            "lastReceivedKey": {
-                "fromMe": false,
-                "remote": {
-                    "server": "g.us",
-                    "user": "120363042118385076",
-                    "_serialized": "120363042118385076@g.us"
-                },
-                "id": "3EB09228CB1C1ABF7B25",
-                "_serialized": "false_120363042118385076@g.us_3EB09228CB1C1ABF7B25"
-                },
-                "unreadCount": 0,
-                "muteExpiration": 0,
-                "hasUnreadMention": false,
-                "archiveAtMentionViewedInDrawer": false,
-                "hasChatBeenOpened": false,
-                "pendingInitialLoading": false,
-                "msgs": null,
-                "kind": "group",
-                "canSend": true,
-                "isGroup": true,
-                "contact": {
-                "id": "120363042118385076@g.us",
-                "type": "in",
-                "formattedName": "",
-                "isMe": false,
-                "isMyContact": false,
-                "isPSA": false,
-                "isUser": false,
-                "isWAContact": false,
-                "profilePicThumbObj": {
-                    "id": "120363042118385076@g.us",
-                    "img": null,
-                    "imgFull": null
-                },
-                "msgs": null
-                },
-                "groupMetadata": {
-                    "id": "120363042118385076@g.us",
-                    "suspended": false,
-                    "terminated": false,
-                    "uniqueShortNameMap": {},
-                    "participants": [],
-                    "pendingParticipants": [],
-                    "pastParticipants": [],
-                    "membershipApprovalRequests": []
-                },
-                "presence": {
-                "id": {
-                    "server": "g.us",
-                    "user": "120363042118385076",
-                    "_serialized": "120363042118385076@g.us"
-                },
-                "chatstates": []
-            },
-            "isOnline": false,
-            "participantsCount": 1
-        }
-    }
+    yields the campaign's message rows joined with their link, in chunks of EXPORT_CHUNK_SIZE. yield_per reads them
+    over a server-side cursor where the driver has one, so memory stays flat however big the campaign is. error is
+    the last failed step of the message
     """
-    whatsapp = Whatsapp(os.environ.get('API_BASE_URL'))
-
-    for i, link in enumerate(links_list):
-        # create message record in database
-        msg = Message(campaign_id=campaign_id, group_link=link.id)
-        db.session.add(msg)
-        db.session.commit()
-        db.session.refresh(msg)
-        
-        """ uncomment the code below and comment the other remaining part to schedule all events. schedule events means,
-        for example, 
-        after joining a group, a new event to send message to that group is scheduled. and after sucessfully sending, a new event to leave group is scheduled.
-        this means, once an event has been scheduled, the code will continue running and processing other events that were scheduled before. that means, you
-        could see in your whatsapp, the bot sending a message to one group, leaving other 2 joining other 3 group... leving others sending to others... events
-        seem kinda random. but it's good since if one event fails, for example if a message is not sent, the bot will not leave the group since that event will 
-        not be scheduled """
-        # join_group.schedule(
-        #     timedelta(seconds=(i + 1) * 10),
-        #     whatsapp=whatsapp,
-        #     group_link=link,
-        #     message=msg, text=message
-        # )
-        # logger.info(f" scheduled {link.link} for {(i + 1) * 10} seconds")
-
-        # join group
-        
-        """if you uncomment the code above, then you should comment everythng else on this function below this quote. When uncommented as it is, the bot
-        will perform actions in the same order. join one group, send message, then leave....only then will it go to the next group. if an error occurs it will
-        stop there for the group. NOTE:  with this setup, tests we did showed the bot could join a group, and leave without sending the message"""
-        code, join_resp = whatsapp.join_group(link.link)
-        if code == 200 and join_resp["success"]:
-            group_chat_id: str = join_resp["response"]["id"]
-            logger.info(f"successfully joined group with id: {group_chat_id}")
-
-            db.session.refresh(msg)
-            msg.join_succeeded = True
-            db.session.commit()
-            if group_chat_id.endswith('@g.us'):
-
-                # send message
-                send_code, send_resp = whatsapp.send_text(
-                    chat_id=group_chat_id, message=message)
-                if send_code == 200 and send_resp['success']:
-                    logger.info("successfully sent message to group")
-
-                    db.session.refresh(msg)
-                    msg.message_send_succeeded = True
-                    msg.response_dump = json.dumps(send_resp)
-                    db.session.commit()
-                    # update message here
-
-                    time.sleep(2)
-                else:
-                    db.session.refresh(msg)
-                    msg.message_send_succeeded = False
-                    msg.response_dump = json.dumps(send_resp)
-                    db.session.commit()
-                    logger.info(f"message sending DID NOT SUCCEED: {send_resp}")
-
-                # leave group
-                if bool(int(os.environ.get('EXIT_GROUPS', False))):
-                    time.sleep(10)
-                    exit_code, exit_resp = whatsapp.leave_group(
-                        chat_id=group_chat_id)
-                    if exit_code == 200:
-                        logger.info(f"[LEFT GROUP] {exit_resp}")
-            else:
-                logger.info("malformed link")
-        else:
-            logger.info("joining group DID NOT SUCCEED")
-            db.session.refresh(msg)
-            msg.join_succeeded = True
-            msg.response_dump = json.dumps(join_resp)
-            db.session.commit()
-
-    logger.info(
-        f" [campaign:{campaign_id}] DONE PROCESSING ALL LINKS IN THIS CAMPAIGN")
+    last_error = db.select(MessageStep.error).where(
+        MessageStep.message_id == Message.id, MessageStep.success.is_(False)).order_by(
+        MessageStep.id.desc()).limit(1).scalar_subquery()
+    query = db.select(
+        Message.id, GroupLink.id, GroupLink.link, GroupLink.name, GroupLink.chat_id, GroupLink.wa_session,
+        Message.join_succeeded, Message.message_send_succeeded, last_error, Message.sent_at, Message.updated
+    ).join(GroupLink, GroupLink.id == Message.group_link).where(Message.campaign_id == campaign_id).order_by(Message.id)
+    result = db.session.execute(query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+    for chunk in result.partitions():
+        yield chunk
+
+
+def export_csv(chunks):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_COLUMNS)
+    for chunk in chunks:
+        writer.writerows(chunk)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+
+def export_jsonl(chunks):
+    for chunk in chunks:
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=str) + '\n' for row in chunk)
 
 
 def run_campaign_task(id, **kwargs):
     with app.app_context():
         campaign: Campaign = db.session.execute(
             db.select(Campaign).filter_by(id=id)).scalars().one()
-        links = db.session.execute(
-            db.select(GroupLink).filter_by(active=True)).scalars().all()
 
         if campaign:
             logger.info(f"PREPARING TO RUN CAMPAIGN :: {campaign}")
             logger.info(f">>>> :: {campaign.message}")
-            campaign_task.queue(links, campaign.message, campaign.id)
-            # campaign_task(links, campaign.message, campaign.id)
-
-            campaign.has_run = True
-            db.session.add(campaign)
-            db.session.commit()
-            flash(
-                f'Campaign [{campaign.title}] has started running successfully. Check your phone to see the progress.')
+            resumed = campaign.has_run
+            if not queue_campaign(campaign):
+                flash(f'Campaign [{campaign.title}] is still running.')
+            elif resumed:
+                flash(f'Campaign [{campaign.title}] has resumed. Groups that already got the message are skipped.')
+            else:
+                flash(
+                    f'Campaign [{campaign.title}] has started running successfully. Check your phone to see the progress.')
         # elif campaign.has_run: logger.info(f"CAMPAIGN :: {campaign} :: HAS ALREADY BEEN RUN") flash(f'Campaign [{
         # campaign.title}] has already been run. If this was a mistake, recreate a new campaign and run.')
         else:
@@ -565,6 +467,46 @@ def run_campaign():
     return redirect(url_for('campaigns'))
 
 
+@app.route('/campaign/<int:campaign_id>/progress', methods=['GET'])
+@flask_login.login_required
+def campaign_progress_view(campaign_id):
+    campaign = Campaign.query.get_or_404(campaign_id)
+    return jsonify({'id': campaign.id, 'title': campaign.title, **campaign_progress(campaign_id)})
+
+
+@app.route('/campaign/<int:campaign_id>/export', methods=['GET'])
+@flask_login.login_required
+def campaign_export(campaign_id):
+    # ?format=csv (default) or jsonl. rows are streamed as they are read, the download starts right away and the web
+    # process never holds more than EXPORT_CHUNK_SIZE of them
+    campaign = Campaign.query.get_or_404(campaign_id)
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'jsonl'):
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+    rows = export_rows(campaign.id)
+    body = export_csv(rows) if export_format == 'csv' else export_jsonl(rows)
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=campaign-{campaign.id}.{export_format}'})
+
+
+@app.route('/queues', methods=['GET'])
+@flask_login.login_required
+def queues():
+    return jsonify({'queues': queue_stats()})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # prometheus text format. it names the sessions and shows campaign volumes, so it is not left open
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+    elif not flask_login.current_user.is_authenticated:
+        return login_manager.unauthorized()
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/link/delete', methods=['POST'])
 @flask_login.login_required
 def delete_link():
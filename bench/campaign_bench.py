@@ -0,0 +1,274 @@
+"""
+campaign throughput benchmark against the fake open-wa api in bench/fake_api.py. runs on a throwaway sqlite file and a
+local redis. the redis database given by --redis-url is FLUSHED before every run, so point it at a spare db index.
+
+    python -m bench.campaign_bench --links 500 --engines sequential fanout async chain --latency 0.1 --rate-limit 50
+
+sequential, fanout and async queue campaign_task with that engine, chain queues the join_group -> send_msg_to_group
+job chain for every link. jobs are run by an in-process burst worker, or with --workers N by N worker processes forked
+from the bench that work until the queues are drained, the way a worker deployment runs them. every run reports
+groups/sec, p50/p99 latency per api step, db round trips and the bytes of job payloads written to redis.
+
+    python -m bench.campaign_bench --links 2000 --engines fanout chain --workers 8
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from bench.fake_api import FakeApi
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENGINES = ('sequential', 'fanout', 'async', 'chain')
+# the worker processes hand what their probes saw to the bench through this redis list
+STATS_KEY = 'bench:stats'
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+
+class Recorder:
+    # collects what the probes see during one run
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.latencies = defaultdict(list)
+        self.db_round_trips = 0
+        self.jobs = 0
+        self.payload_bytes = 0
+
+    def dump(self) -> str:
+        return json.dumps({'latencies': self.latencies, 'db_round_trips': self.db_round_trips, 'jobs': self.jobs,
+                           'payload_bytes': self.payload_bytes})
+
+    def merge(self, dumped: str):
+        stats = json.loads(dumped)
+        for endpoint, values in stats['latencies'].items():
+            self.latencies[endpoint].extend(values)
+        self.db_round_trips += stats['db_round_trips']
+        self.jobs += stats['jobs']
+        self.payload_bytes += stats['payload_bytes']
+
+
+def prepare_environment(args, api_url):
+    # core.py reads its settings at import, so everything is set before it is imported
+    workdir = tempfile.mkdtemp(prefix='wa-bench-')
+    os.environ.update({
+        'API_BASE_URL': api_url,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(workdir, "bench.db")}',
+        'RQ_REDIS_URL': args.redis_url,
+        'EXIT_GROUPS': '1' if args.exit_groups else '0',
+        'CAMPAIGN_CONCURRENCY': str(args.concurrency),
+        'ASYNC_CONCURRENCY': str(args.concurrency),
+        'PREFLIGHT_INVITE_CHECK': '1' if args.preflight else '0',
+        'ADAPTIVE_CONTROL': '1' if args.adaptive else '0',
+    })
+    if not args.keep_rate_limits:
+        os.environ.update({'RATE_JOINS_PER_MINUTE': '0', 'RATE_SENDS_PER_MINUTE': '0', 'RATE_LEAVES_PER_MINUTE': '0',
+                           'RATE_CHECKS_PER_MINUTE': '0'})
+    sys.path.insert(0, REPO_ROOT)
+
+
+def install_probes(wa, recorder: Recorder):
+    from rq.queue import Queue
+    from sqlalchemy import event
+
+    def count_query(*args, **kwargs):
+        recorder.db_round_trips += 1
+
+    event.listen(wa.db.engine, 'before_cursor_execute', count_query)
+
+    # record_api_call sees the duration of every api call, retries included
+    record_api_call = wa.record_api_call
+
+    def timed_api_call(endpoint, status, duration, resp):
+        recorder.latencies[endpoint].append(duration)
+        record_api_call(endpoint, status, duration, resp)
+
+    wa.record_api_call = timed_api_call
+
+    enqueue_job = Queue.enqueue_job
+
+    def counted_enqueue_job(queue, job, *args, **kwargs):
+        recorder.jobs += 1
+        recorder.payload_bytes += len(job.data)
+        return enqueue_job(queue, job, *args, **kwargs)
+
+    Queue.enqueue_job = counted_enqueue_job
+
+
+def fork_workers(wa, count: int, recorder: Recorder, log_level: str) -> list:
+    # each process is a SimpleWorker so the probes it inherited see the jobs it runs. it reports them once it is
+    # stopped
+    # nothing of the parent's session may be open in the children
+    wa.db.session.remove()
+    pids = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid:
+            pids.append(pid)
+            continue
+        code = 1
+        try:
+            # the parent's pooled connections stay with the parent, and core.py's logging restarted at LOG_LEVEL
+            wa.db.engine.dispose(close=False)
+            logging.getLogger().setLevel(log_level)
+            recorder.reset()
+            wa.rq.get_worker(*wa.QUEUES).work(logging_level=log_level)
+            wa.rq.connection.rpush(STATS_KEY, recorder.dump())
+            code = 0
+        except Exception:
+            logging.exception(' bench worker failed')
+        finally:
+            wa.flush_logs()
+            os._exit(code)
+    return pids
+
+
+def wait_until_idle(wa, poll: float = 0.02):
+    # done when no job is queued or running on two polls in a row, a job moves from its queue to the started registry
+    # in between the two
+    queues = [wa.rq.get_queue(name) for name in wa.QUEUES]
+    idle = 0
+    while idle < 2:
+        time.sleep(poll)
+        busy = any(queue.count or queue.started_job_registry.count for queue in queues)
+        idle = 0 if busy else idle + 1
+
+
+def stop_workers(wa, pids: list, recorder: Recorder):
+    # warm shutdown, every process is idle by now
+    for pid in pids:
+        os.kill(pid, signal.SIGTERM)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    for dumped in wa.rq.connection.lrange(STATS_KEY, 0, -1):
+        recorder.merge(dumped)
+
+
+def run_engine(wa, engine: str, link_count: int, recorder: Recorder, log_level: str, workers: int = 0) -> dict:
+    wa.db.drop_all()
+    wa.db.create_all()
+    wa.rq.connection.flushdb()
+    now = wa.datetime.now()
+    for chunk in wa.chunked(range(link_count), 500):
+        wa.db.session.execute(wa.db.insert(wa.GroupLink).values(
+            [{'link': f'https://chat.whatsapp.com/Bench{i:08d}', 'active': True, 'created_at': now} for i in chunk]))
+    campaign = wa.Campaign(title=f'bench {engine}', message='benchmark message ' * 10)
+    wa.db.session.add(campaign)
+    wa.db.session.commit()
+    campaign_id = campaign.id
+    link_ids = wa.db.session.execute(wa.db.select(wa.GroupLink.id).order_by(wa.GroupLink.id)).scalars().all()
+
+    recorder.reset()
+    # forked before the clock starts, the way a deployment's workers are already waiting for jobs
+    pids = fork_workers(wa, workers, recorder, log_level)
+    try:
+        started = time.monotonic()
+        if engine == 'chain':
+            message_ids = wa.create_campaign_messages(campaign_id, link_ids)
+            for link_id in link_ids:
+                wa.join_group.queue(link_id, message_ids[link_id])
+        else:
+            wa.campaign_task.queue(campaign_id, engine=engine, timeout=-1)
+        if pids:
+            wait_until_idle(wa)
+        else:
+            wa.rq.get_worker().work(burst=True, logging_level=log_level)
+        elapsed = time.monotonic() - started
+    finally:
+        # a failed or interrupted run must not leave workers behind
+        stop_workers(wa, pids, recorder)
+
+    # groups with an outcome: sent, or failed at the join or the send. a paused run leaves the rest for later, so
+    # the throughput is taken from these, not from the seeded links
+    def count_messages(*where):
+        return wa.db.session.execute(wa.db.select(wa.func.count(wa.Message.id)).where(
+            wa.Message.campaign_id == campaign_id, *where)).scalar()
+
+    sent = count_messages(wa.Message.message_send_succeeded.is_(True))
+    processed = count_messages(wa.or_(wa.Message.message_send_succeeded.isnot(None),
+                                      wa.Message.join_succeeded.is_(False)))
+    return {
+        'engine': engine,
+        'workers': workers,
+        'groups': link_count,
+        'processed': processed,
+        'sent': sent,
+        'elapsed': elapsed,
+        'groups_per_sec': processed / elapsed if elapsed else 0,
+        'latency': {endpoint: (len(values), percentile(values, 50), percentile(values, 99))
+                    for endpoint, values in sorted(recorder.latencies.items())},
+        'db_round_trips': recorder.db_round_trips,
+        'jobs': recorder.jobs,
+        'payload_bytes': recorder.payload_bytes,
+    }
+
+
+def print_report(result: dict):
+    workers = f", {result['workers']} worker processes" if result['workers'] else ''
+    print(f"\n== {result['engine']}{workers}: {result['groups']} groups, {result['processed']} processed, "
+          f"{result['sent']} sent in {result['elapsed']:.2f}s ({result['groups_per_sec']:.2f} processed groups/sec)")
+    for endpoint, (count, p50, p99) in result['latency'].items():
+        print(f"   {endpoint:<20} {count:>7} calls   p50 {p50 * 1000:8.1f} ms   p99 {p99 * 1000:8.1f} ms")
+    print(f"   db round trips       {result['db_round_trips']:>7}   ({result['db_round_trips'] / result['groups']:.2f} "
+          f"per group)")
+    print(f"   redis job payloads   {result['payload_bytes']:>7} bytes in {result['jobs']} jobs")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--links', type=int, default=200, help='number of synthetic group links')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES))
+    parser.add_argument('--concurrency', type=int, default=10, help='fan-out and async in-flight limit')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake api mean response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='fake api response time standard deviation')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of fake api calls answered with a 500')
+    parser.add_argument('--rate-limit', type=int, default=0, help='fake api requests per second before 429s')
+    parser.add_argument('--dead-rate', type=float, default=0.0, help='share of invite links the fake api calls revoked')
+    parser.add_argument('--preflight', action='store_true', help='check invite links before each campaign')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='run with ADAPTIVE_CONTROL set. a tripped circuit breaker schedules the rest of the '
+                             'campaign for later, outside the run')
+    parser.add_argument('--exit-groups', action='store_true',
+                        help='run with EXIT_GROUPS set, the leave sweeper is not part of the run')
+    parser.add_argument('--keep-rate-limits', action='store_true',
+                        help='keep the RATE_* budgets from the environment instead of disabling them')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='run the jobs on this many forked worker processes instead of in the bench process')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15', help='redis db to use, it gets flushed')
+    parser.add_argument('--verbose', action='store_true', help='keep the app and worker INFO logs')
+    args = parser.parse_args(argv)
+
+    api = FakeApi(args.latency, args.jitter, args.error_rate, args.rate_limit, dead_rate=args.dead_rate).start()
+    prepare_environment(args, api.url)
+    # the worker entrypoint, the web app and its users.yaml are not needed
+    import core as wa
+    from worker import app
+    log_level = 'INFO' if args.verbose else 'WARNING'
+    logging.getLogger().setLevel(log_level)
+    # jobs run in the bench's own processes so the probes see them
+    wa.rq.worker_class = 'rq.worker.SimpleWorker'
+
+    recorder = Recorder()
+    with app.app_context():
+        install_probes(wa, recorder)
+        for engine in args.engines:
+            print_report(run_engine(wa, engine, args.links, recorder, log_level, args.workers))
+    print(f"\nfake api responses: {dict(sorted(api.responses.items()))}")
+    api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+stand-in for the open-wa api, for benchmarks and for clicking around the ui without a phone.
+implements /joinGroupViaLink, /getGroupInfoFromInviteLink, /sendText and /leaveGroup with configurable latency, error
+rate, 429 throttling and a share of dead invite links.
+
+    python -m bench.fake_api --port 8002 --latency 0.2 --error-rate 0.05 --rate-limit 20
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeApi:
+
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, rate_limit=0, host='127.0.0.1', port=0,
+                 dead_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # share of invite links that are revoked, always the same links for a given rate
+        self.dead_rate = dead_rate
+        # requests per second the fake session accepts before answering 429, 0 for no limit
+        self.rate_limit = rate_limit
+        self.responses = Counter()
+        self._chat_ids = itertools.count(120363000000000000)
+        self._recent = deque()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-open-wa', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def throttled(self) -> bool:
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 1:
+                self._recent.popleft()
+            if len(self._recent) >= self.rate_limit:
+                return True
+            self._recent.append(now)
+            return False
+
+    def is_dead(self, link: str) -> bool:
+        return int(hashlib.md5(link.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF < self.dead_rate
+
+    def respond(self, path: str, args: dict) -> tuple:
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if self.throttled():
+            return 429, {'success': False, 'error': 'Too Many Requests'}
+        if random.random() < self.error_rate:
+            return 500, {'success': False, 'error': 'fake failure'}
+        if path in ('/joinGroupViaLink', '/getGroupInfoFromInviteLink') and self.is_dead(
+                args.get('link') or args.get('inviteCode') or ''):
+            return 200, {'success': False, 'response': 'ERROR: invite link revoked'}
+        if path == '/getGroupInfoFromInviteLink':
+            return 200, {'success': True, 'response': {'id': 'unknown@g.us', 'subject': 'group', 'size': 42}}
+        if path == '/joinGroupViaLink':
+            chat_id = f'{next(self._chat_ids)}@g.us'
+            return 200, {'success': True, 'response': {'id': chat_id, 'name': f'group {chat_id[-6:]}', 'kind': 'group'}}
+        if path == '/sendText':
+            return 200, {'success': True, 'response': f'true_{args.get("to")}_{random.getrandbits(64):016X}'}
+        if path == '/leaveGroup':
+            return 200, {'success': True, 'response': True}
+        return 404, {'success': False, 'error': f'unknown endpoint {path}'}
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in separate writes, nagle + delayed acks would add ~40ms to every call
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                # health check used by the dashboard
+                self._reply(200, {'success': True})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                args = json.loads(body or b'{}').get('args', {})
+                status, payload = api.respond(self.path, args)
+                with api._lock:
+                    api.responses[(self.path, status)] += 1
+                self._reply(status, payload)
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8002)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the response time')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 500')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests per second before answering 429')
+    parser.add_argument('--dead-rate', type=float, default=0.0, help='share of invite links that are revoked')
+    args = parser.parse_args()
+    api = FakeApi(args.latency, args.jitter, args.error_rate, args.rate_limit, args.host, args.port, args.dead_rate)
+    print(f'fake open-wa api listening on {api.url}')
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2122 @@
+"""
+everything the rq workers need: settings, models, the open-wa client and the job functions. nothing here loads the web
+ui (users.yaml, flask-login, routes), app.py builds that on top and worker.py is the lightweight worker entrypoint.
+"""
+import asyncio
+import atexit
+import bisect
+import contextvars
+import hashlib
+import itertools
+import logging
+import logging.handlers
+import math
+import queue
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from random import random, uniform
+
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from datetime import datetime, timedelta
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask_rq2 import RQ
+from rq import Worker
+from rq.job import Job
+from redis.exceptions import RedisError
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, inspect, or_, text
+
+# ------------------------- logging -------------------------
+LOG_FORMAT = ' - %(message)s%(context)s'
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# one json object per line instead of the plain text format
+LOG_JSON = bool(int(os.environ.get('LOG_JSON', False)))
+# share of open-wa calls whose payload and response body are logged at DEBUG, every call gets a one line summary
+LOG_BODY_SAMPLE_RATE = float(os.environ.get('LOG_BODY_SAMPLE_RATE', 0.1))
+
+_log_ids = contextvars.ContextVar('log_ids', default={})
+
+
+@contextmanager
+def log_context(**ids):
+    # ids like campaign, session or link are added to every record logged inside the block, asyncio tasks included
+    token = _log_ids.set({**_log_ids.get(), **{name: value for name, value in ids.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _log_ids.reset(token)
+
+
+class LogContextFilter(logging.Filter):
+    # runs in the thread that logs, before the record is queued, so it sees that thread's context
+    def filter(self, record):
+        record.ids = _log_ids.get()
+        record.context = f" [{' '.join(f'{name}:{value}' for name, value in record.ids.items())}]" if record.ids else ''
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage().strip(),
+            **getattr(record, 'ids', {}),
+        }, default=str)
+
+
+log_listener = None
+
+
+def start_logging():
+    # records are queued by the thread that logs and written out by a listener thread, so jobs never wait on stderr.
+    # forked children (rq work horses) start their own listener, the parent's thread does not survive the fork
+    global log_listener
+    log_queue = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(LogContextFilter())
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    log_listener = logging.handlers.QueueListener(log_queue, stream)
+    log_listener.start()
+
+
+def flush_logs():
+    # stop() returns once the listener wrote everything queued so far
+    log_listener.stop()
+    log_listener.start()
+
+
+class AppWorker(Worker):
+    # the rq worker of every queue: checks the schema, records how long jobs waited and writes out the logs of jobs
+    def execute_job(self, job, queue):
+        # runs before the work horse is forked, so the check is made once per worker process
+        ensure_schema()
+        return super().execute_job(job, queue)
+
+    def perform_job(self, job, queue):
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            if job.enqueued_at and job.started_at:
+                record_job_wait(queue.name, (job.started_at - job.enqueued_at).total_seconds())
+            # a work horse leaves through os._exit, which skips atexit, so its logs are written out here
+            flush_logs()
+
+
+start_logging()
+os.register_at_fork(after_in_child=start_logging)
+atexit.register(lambda: log_listener.stop())
+logger = logging.getLogger(__name__)
+
+# ------------------------- extensions -------------------------
+# bound to a flask app by init_app, app.py binds them to the web app and worker.py to a bare one
+rq = RQ()
+db = SQLAlchemy()
+# named queues in priority order. a worker listening on several always takes the next job from the first non-empty one,
+# so sends go ahead of joins, joins ahead of leaves and all of them ahead of campaign jobs, which can run for hours.
+# a worker started without queue names listens on all of them
+QUEUES = ('send', 'join', 'leave', 'campaign', 'default')
+
+
+def init_app(app: Flask):
+    # rq configs
+    app.config['RQ_REDIS_URL'] = os.environ.get('RQ_REDIS_URL', 'redis://localhost:6379/0')
+    app.config['RQ_WORKER_CLASS'] = f'{__name__}.AppWorker'
+    app.config['RQ_QUEUES'] = list(QUEUES)
+    rq.init_app(app)
+
+    # db configs
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SQLALCHEMY_DATABASE_URI', "sqlite:///wa.db")
+    db.init_app(app)
+
+    app.cli.add_command(resume_campaigns)
+    app.cli.add_command(schedule_jobs)
+
+
+# campaign engine: "sequential" walks all links in one job, "fanout" runs one job per group across the workers,
+# "async" drives many groups at once from a single job over an event loop
+CAMPAIGN_ENGINE = os.environ.get('CAMPAIGN_ENGINE', 'sequential')
+# campaign jobs read links this many at a time. a sequential or async campaign runs in one job, so its timeout is
+# generous (seconds, -1 for none)
+CAMPAIGN_CHUNK_SIZE = int(os.environ.get('CAMPAIGN_CHUNK_SIZE', 500))
+CAMPAIGN_TIMEOUT = int(os.environ.get('CAMPAIGN_TIMEOUT', 24 * 60 * 60))
+# max number of group jobs a fan-out campaign keeps in flight
+CAMPAIGN_CONCURRENCY = int(os.environ.get('CAMPAIGN_CONCURRENCY', 5))
+# max number of groups the async engine keeps in flight
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', 20))
+# message results are written in batches, once this many rows are pending or this many seconds have passed
+MESSAGE_FLUSH_SIZE = int(os.environ.get('MESSAGE_FLUSH_SIZE', 50))
+MESSAGE_FLUSH_INTERVAL = float(os.environ.get('MESSAGE_FLUSH_INTERVAL', 10))
+# rows per insert statement when a campaign's message records are created up front
+MESSAGE_INSERT_CHUNK_SIZE = int(os.environ.get('MESSAGE_INSERT_CHUNK_SIZE', 500))
+# a running campaign shard holds a lock that its job renews every third of CAMPAIGN_LOCK_TTL seconds. a second run of
+# the same campaign is skipped while it is held, it expires this long after its worker was killed
+CAMPAIGN_LOCK_TTL = int(os.environ.get('CAMPAIGN_LOCK_TTL', 300))
+# a finished campaign's progress counters are kept this many seconds for its progress page
+CAMPAIGN_PROGRESS_TTL = int(os.environ.get('CAMPAIGN_PROGRESS_TTL', 7 * 24 * 60 * 60))
+# seconds we trust that the bot is still a member of a group it joined, without joining again
+MEMBERSHIP_TTL = int(os.environ.get('MEMBERSHIP_TTL', 6 * 60 * 60))
+
+EXIT_GROUPS = bool(int(os.environ.get('EXIT_GROUPS', False)))
+# with EXIT_GROUPS, sweep_leaves leaves groups that were last joined or sent to LEAVE_AFTER seconds ago, at most
+# LEAVE_BATCH_SIZE per sweep
+LEAVE_AFTER = int(os.environ.get('LEAVE_AFTER', 600))
+LEAVE_BATCH_SIZE = int(os.environ.get('LEAVE_BATCH_SIZE', 20))
+
+# pacing budgets shared by every worker through redis, in actions per minute. 0 disables the limit
+RATE_JOINS_PER_MINUTE = float(os.environ.get('RATE_JOINS_PER_MINUTE', 12))
+RATE_SENDS_PER_MINUTE = float(os.environ.get('RATE_SENDS_PER_MINUTE', 12))
+RATE_LEAVES_PER_MINUTE = float(os.environ.get('RATE_LEAVES_PER_MINUTE', 6))
+# how many actions of a kind may go out back to back after an idle period
+RATE_BURST = int(os.environ.get('RATE_BURST', 1))
+# invite checks made by the pre-flight pass, per minute and session
+RATE_CHECKS_PER_MINUTE = float(os.environ.get('RATE_CHECKS_PER_MINUTE', 60))
+# a join, send or fan-out group job sleeps at most RATE_MAX_WAIT seconds for its turn, a longer wait schedules it
+# again for when its turn comes. STEP_JOB_TIMEOUT is those jobs' timeout, it has to cover the api calls and retries
+RATE_MAX_WAIT = float(os.environ.get('RATE_MAX_WAIT', 30))
+STEP_JOB_TIMEOUT = int(os.environ.get('STEP_JOB_TIMEOUT', 600))
+
+# a link whose join fails is skipped for LINK_RETRY_BACKOFF seconds, doubling with every failure in a row up to
+# LINK_RETRY_BACKOFF_MAX, and quarantined after LINK_MAX_FAILURES until it is saved again
+LINK_MAX_FAILURES = int(os.environ.get('LINK_MAX_FAILURES', 5))
+LINK_RETRY_BACKOFF = int(os.environ.get('LINK_RETRY_BACKOFF', 60 * 60))
+LINK_RETRY_BACKOFF_MAX = int(os.environ.get('LINK_RETRY_BACKOFF_MAX', 7 * 24 * 60 * 60))
+# ask the api whether invite links are still valid before a campaign starts, see check_invite_links
+PREFLIGHT_INVITE_CHECK = bool(int(os.environ.get('PREFLIGHT_INVITE_CHECK', False)))
+
+# adaptive pacing per session, see SessionHealth. 429s, 5xx, failed calls and calls slower than ADAPTIVE_LATENCY_TARGET
+# seconds cut the session's rates and in-flight limit by ADAPTIVE_DECREASE (at most once per ADAPTIVE_WINDOW seconds),
+# every other call adds ADAPTIVE_INCREASE back. the scale stays between ADAPTIVE_MIN_SCALE and 1 (the RATE_* budgets)
+ADAPTIVE_CONTROL = bool(int(os.environ.get('ADAPTIVE_CONTROL', True)))
+ADAPTIVE_LATENCY_TARGET = float(os.environ.get('ADAPTIVE_LATENCY_TARGET', 10))
+ADAPTIVE_INCREASE = float(os.environ.get('ADAPTIVE_INCREASE', 0.05))
+ADAPTIVE_DECREASE = float(os.environ.get('ADAPTIVE_DECREASE', 0.5))
+ADAPTIVE_MIN_SCALE = float(os.environ.get('ADAPTIVE_MIN_SCALE', 0.1))
+ADAPTIVE_WINDOW = float(os.environ.get('ADAPTIVE_WINDOW', 10))
+# circuit breaker: once BREAKER_FAILURE_RATIO of at least BREAKER_MIN_CALLS calls in a BREAKER_WINDOW seconds window
+# failed (429, 5xx, no response), the session's campaigns pause for BREAKER_COOLDOWN seconds and are queued again to
+# carry on from there. the window has to hold BREAKER_MIN_CALLS calls at the RATE_* budgets, a few per second at most
+BREAKER_FAILURE_RATIO = float(os.environ.get('BREAKER_FAILURE_RATIO', 0.5))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 10))
+BREAKER_WINDOW = float(os.environ.get('BREAKER_WINDOW', 300))
+BREAKER_COOLDOWN = int(os.environ.get('BREAKER_COOLDOWN', 300))
+
+# every join and send call leaves a small MessageStep record. the raw api response is kept with it, zlib compressed,
+# for failed calls only ("errors"), for "all" calls or for "none", and dropped after STEP_PAYLOAD_RETENTION_DAYS
+STEP_PAYLOADS = os.environ.get('STEP_PAYLOADS', 'errors')
+STEP_PAYLOAD_RETENTION_DAYS = int(os.environ.get('STEP_PAYLOAD_RETENTION_DAYS', 7))
+
+# open-wa http client
+WA_CONNECT_TIMEOUT = float(os.environ.get('WA_CONNECT_TIMEOUT', 5))
+WA_READ_TIMEOUT = float(os.environ.get('WA_READ_TIMEOUT', 60))
+WA_MAX_RETRIES = int(os.environ.get('WA_MAX_RETRIES', 3))
+WA_BACKOFF_FACTOR = float(os.environ.get('WA_BACKOFF_FACTOR', 0.5))
+WA_BACKOFF_MAX = float(os.environ.get('WA_BACKOFF_MAX', 30))
+WA_POOL_SIZE = int(os.environ.get('WA_POOL_SIZE', 10))
+# open-wa sessions, one per linked phone number, as a json list:
+# [{"name": "phone1", "url": "http://wa1:8002", "weight": 2, "joins_per_minute": 12, "sends_per_minute": 12,
+#   "leaves_per_minute": 6, "burst": 1}, ...]
+# weight is the session's share of groups nobody has joined yet, the rate keys default to the RATE_* budgets. a group
+# stays with the session that joined it. unset means a single session on API_BASE_URL
+WA_SESSIONS = json.loads(os.environ.get('WA_SESSIONS') or 'null') or [
+    {'name': 'default', 'url': os.environ.get('API_BASE_URL')}]
+
+
+class GroupLink(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    link = db.Column(db.String(150), unique=True, nullable=False)
+    active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime(timezone=True), default=datetime.now())
+    chat_id = db.Column(db.String(100), default=None)
+    name = db.Column(db.String(250), default=None)
+    # name of the open-wa session that joined the group, campaigns keep sending to it through that session
+    wa_session = db.Column(db.String(50), default=None)
+    # when the bot last joined or used its membership of the group, None once it left. the leave sweeper reads it
+    joined_at = db.Column(db.DateTime(timezone=True), default=None)
+    # joins that failed in a row, when the link may be tried again, and when it was given up on
+    failure_count = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), default=None)
+    quarantined_at = db.Column(db.DateTime(timezone=True), default=None)
+
+    # listings and campaigns filter on active and walk by id
+    __table_args__ = (db.Index('ix_group_link_active_id', 'active', 'id'),
+                      db.Index('ix_group_link_joined_at', 'joined_at'))
+
+
+class Campaign(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(200), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    has_run = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime(timezone=True), default=datetime.now())
+    started_at = db.Column(db.DateTime(timezone=True))
+    finished_at = db.Column(db.DateTime(timezone=True))
+    active = db.Column(db.Boolean, default=True)
+
+    __table_args__ = (db.Index('ix_campaign_active_id', 'active', 'id'),)
+
+
+class Message(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey(
+        'campaign.id'), nullable=False)
+    group_link = db.Column(db.Integer, db.ForeignKey(
+        'group_link.id'), nullable=False)
+    sent_at = db.Column(db.DateTime(timezone=True), default=datetime.now())
+    join_succeeded = db.Column(db.Boolean)
+    message_send_succeeded = db.Column(db.Boolean)
+    # raw responses of runs from before MessageStep, cleared by purge_step_payloads
+    response_dump = db.Column(db.Text)
+    updated = db.Column(db.DateTime(timezone=True), onupdate=datetime.now())
+
+    # one row per group per campaign. re-running a campaign resumes on these rows instead of creating new ones
+    __table_args__ = (db.Index('uq_message_campaign_link', 'campaign_id', 'group_link', unique=True),)
+
+
+class MessageStep(db.Model):
+    # outcome of one api call made for a message: join or send
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False, index=True)
+    step = db.Column(db.String(10), nullable=False)
+    # None when the call never got an http response
+    status_code = db.Column(db.SmallInteger)
+    success = db.Column(db.Boolean, nullable=False)
+    chat_id = db.Column(db.String(100))
+    error = db.Column(db.String(100))
+    duration_ms = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime(timezone=True), default=datetime.now)
+    payload = db.Column(db.LargeBinary)
+
+    def response(self):
+        # the raw api response, if STEP_PAYLOADS kept it and it has not been purged yet
+        return json.loads(zlib.decompress(self.payload)) if self.payload else None
+
+
+def add_missing_columns(model):
+    # create_all never alters a table that already exists, columns added to a model later are added here
+    table = model.__table__
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    quote = db.engine.dialect.identifier_preparer.quote
+    for column in table.columns:
+        if column.name not in existing:
+            logger.info(f" adding column {table.name}.{column.name}")
+            with db.engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} '
+                                  f'{column.type.compile(db.engine.dialect)}'))
+
+
+schema_lock = threading.Lock()
+schema_ready = False
+
+
+def ensure_schema() -> bool:
+    """
+    creates missing tables, columns and indexes, once per process. workers call it before their first job instead of at
+    import, so a database that is briefly unreachable at boot is logged and checked again with the next job rather than
+    crashing the worker. returns whether the schema is in place
+    """
+    global schema_ready
+    if schema_ready:
+        return True
+    with schema_lock:
+        if schema_ready:
+            return True
+        try:
+            db.create_all()
+            for model in (GroupLink, Campaign, Message, MessageStep):
+                add_missing_columns(model)
+            # create_all skips tables that already exist, so indexes added later are created here
+            for index in (*GroupLink.__table__.indexes, *Campaign.__table__.indexes, *Message.__table__.indexes):
+                try:
+                    index.create(bind=db.engine, checkfirst=True)
+                except IntegrityError:
+                    # messages from campaigns that were run more than once before resuming existed
+                    logger.warning(f"could not create {index.name}, remove the duplicate rows it covers and restart")
+            schema_ready = True
+        except SQLAlchemyError:
+            logger.exception(" schema check failed, trying again later")
+        finally:
+            # work horses are forked from this process, they must not inherit the connections the check opened
+            db.engine.dispose()
+        return schema_ready
+
+
+# ------------------------- metrics -------------------------
+# every worker process adds to one redis hash whose fields are prometheus sample names, so /metrics serves the totals
+# of the whole deployment. per campaign counters live in campaign:<id>:progress, the ids of the campaigns that are
+# running in ACTIVE_CAMPAIGNS_KEY.
+METRICS_KEY = 'metrics'
+ACTIVE_CAMPAIGNS_KEY = 'campaigns:active'
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+WAIT_BUCKETS = (1, 5, 15, 60, 300, 900, 3600)
+METRIC_TYPES = {
+    'wa_request_duration_seconds': 'histogram',
+    'wa_requests_total': 'counter',
+    'wa_calls_total': 'counter',
+    'rq_job_wait_seconds': 'histogram',
+}
+HISTOGRAM_BUCKETS = {
+    'wa_request_duration_seconds': LATENCY_BUCKETS,
+    'rq_job_wait_seconds': WAIT_BUCKETS,
+}
+
+
+def record_api_call(endpoint: str, status, duration: float, resp):
+    # latency histogram and status code count per endpoint, plus a success/failure count per endpoint (join, send
+    # and leave success rates). metrics are best effort and never fail the call
+    labels = f'endpoint="{endpoint}"'
+    succeeded = status == 200 and isinstance(resp, dict) and bool(resp.get('success'))
+    try:
+        pipe = rq.connection.pipeline(transaction=False)
+        for bound in LATENCY_BUCKETS:
+            if duration <= bound:
+                pipe.hincrby(METRICS_KEY, f'wa_request_duration_seconds_bucket{{{labels},le="{bound}"}}', 1)
+        pipe.hincrby(METRICS_KEY, f'wa_request_duration_seconds_bucket{{{labels},le="+Inf"}}', 1)
+        pipe.hincrbyfloat(METRICS_KEY, f'wa_request_duration_seconds_sum{{{labels}}}', duration)
+        pipe.hincrby(METRICS_KEY, f'wa_request_duration_seconds_count{{{labels}}}', 1)
+        pipe.hincrby(METRICS_KEY, f'wa_requests_total{{{labels},status="{status}"}}', 1)
+        pipe.hincrby(METRICS_KEY, f'wa_calls_total{{{labels},outcome="{"success" if succeeded else "failure"}"}}', 1)
+        pipe.execute()
+    except RedisError:
+        logger.warning(" could not record api metrics", exc_info=True)
+
+
+def record_job_wait(queue: str, wait: float):
+    # time from a job being queued to a worker starting it, per queue
+    labels = f'queue="{queue}"'
+    try:
+        pipe = rq.connection.pipeline(transaction=False)
+        for bound in WAIT_BUCKETS:
+            if wait <= bound:
+                pipe.hincrby(METRICS_KEY, f'rq_job_wait_seconds_bucket{{{labels},le="{bound}"}}', 1)
+        pipe.hincrby(METRICS_KEY, f'rq_job_wait_seconds_bucket{{{labels},le="+Inf"}}', 1)
+        pipe.hincrbyfloat(METRICS_KEY, f'rq_job_wait_seconds_sum{{{labels}}}', wait)
+        pipe.hincrby(METRICS_KEY, f'rq_job_wait_seconds_count{{{labels}}}', 1)
+        pipe.execute()
+    except RedisError:
+        logger.warning(" could not record job wait metrics", exc_info=True)
+
+
+def queue_stats() -> List[dict]:
+    # depth and age of the oldest waiting job of every queue, in priority order
+    stats = []
+    now = datetime.utcnow()
+    for name in QUEUES:
+        queue = rq.get_queue(name)
+        oldest = queue.get_jobs(0, 1)
+        stats.append({
+            'queue': name,
+            'depth': queue.count,
+            'oldest_wait_seconds': round((now - oldest[0].enqueued_at).total_seconds(), 1)
+            if oldest and oldest[0].enqueued_at else 0,
+            'running': queue.started_job_registry.count,
+            'failed': queue.failed_job_registry.count,
+            'workers': Worker.count(queue=queue),
+        })
+    return stats
+
+
+def progress_key(campaign_id):
+    return f'campaign:{campaign_id}:progress'
+
+
+def start_progress(campaign_id, queued: int):
+    pipe = rq.connection.pipeline()
+    pipe.delete(progress_key(campaign_id))
+    pipe.hset(progress_key(campaign_id), mapping={
+        'queued': queued, 'joined': 0, 'sent': 0, 'failed': 0, 'started_at': time.time()})
+    pipe.sadd(ACTIVE_CAMPAIGNS_KEY, campaign_id)
+    pipe.execute()
+
+
+def finish_progress(campaign_id):
+    # the counters stay for CAMPAIGN_PROGRESS_TTL, /metrics stops reporting the campaign right away
+    pipe = rq.connection.pipeline()
+    pipe.hset(progress_key(campaign_id), 'finished_at', time.time())
+    pipe.expire(progress_key(campaign_id), CAMPAIGN_PROGRESS_TTL)
+    pipe.srem(ACTIVE_CAMPAIGNS_KEY, campaign_id)
+    pipe.execute()
+
+
+def count_progress(campaign_id, **counts):
+    counts = {field: n for field, n in counts.items() if n}
+    if campaign_id is None or not counts:
+        return
+    try:
+        pipe = rq.connection.pipeline(transaction=False)
+        for field, n in counts.items():
+            pipe.hincrby(progress_key(campaign_id), field, n)
+        pipe.execute()
+    except RedisError:
+        logger.warning(" could not record campaign progress", exc_info=True)
+
+
+def campaign_progress(campaign_id) -> dict:
+    raw = {k.decode(): float(v) for k, v in rq.connection.hgetall(progress_key(campaign_id)).items()}
+    if not raw:
+        return {}
+    # set per session while its circuit breaker holds the campaign back
+    paused_until = {name.split(':', 1)[1]: datetime.fromtimestamp(until).isoformat()
+                    for name, until in raw.items() if name.startswith('paused_until:') and until > time.time()}
+    # the hash can be created by count_progress alone, e.g. by job chains queued without a campaign run
+    queued, processed = int(raw.get('queued', 0)), int(raw.get('sent', 0) + raw.get('failed', 0))
+    elapsed = raw.get('finished_at', time.time()) - raw['started_at'] if 'started_at' in raw else 0
+    rate = processed / elapsed * 60 if elapsed > 0 else 0
+    return {
+        'queued': queued,
+        'joined': int(raw.get('joined', 0)),
+        'sent': int(raw.get('sent', 0)),
+        'failed': int(raw.get('failed', 0)),
+        'processed': processed,
+        'groups_per_minute': round(rate, 2),
+        'eta_seconds': None if 'finished_at' in raw or not rate else round(max(0, queued - processed) / rate * 60),
+        'started_at': datetime.fromtimestamp(raw['started_at']).isoformat() if 'started_at' in raw else None,
+        'finished_at': datetime.fromtimestamp(raw['finished_at']).isoformat() if 'finished_at' in raw else None,
+        'paused_until': paused_until,
+    }
+
+
+def backoff_delay(attempt: int):
+    # exponential backoff with full jitter, so workers retrying at the same time don't hit the api in lockstep
+    backoff = min(WA_BACKOFF_MAX, WA_BACKOFF_FACTOR * (2 ** attempt))
+    return uniform(0, backoff) if backoff > 0 else 0
+
+
+class JitteredRetry(Retry):
+    def get_backoff_time(self):
+        backoff = min(WA_BACKOFF_MAX, super().get_backoff_time())
+        return uniform(0, backoff) if backoff > 0 else 0
+
+
+# http statuses a call is retried on. a gateway's 502 or 504 may come after open-wa already sent the text, so sends are
+# only retried on 503 (nothing was processed) and failed connects, a duplicate message is worse than a failed one
+RETRY_STATUSES = (500, 502, 503, 504)
+SEND_RETRY_STATUSES = (503,)
+
+
+def retry_statuses(endpoint: str) -> tuple:
+    return SEND_RETRY_STATUSES if endpoint == '/sendText' else RETRY_STATUSES
+
+
+class Whatsapp:
+    # one pooled keep-alive session per worker process and retry policy, shared by every Whatsapp instance
+    _sessions = {}
+    _sessions_pid = None
+
+    def __init__(self, url, health: 'SessionHealth' = None):
+        logger.info(f"BASE URL : {url}")
+        self.base_url = url
+        self.health = health
+
+    @classmethod
+    def session(cls, endpoint: str = None) -> requests.Session:
+        # rebuilt after a fork so child processes never share sockets with the parent
+        if cls._sessions_pid != os.getpid():
+            cls._sessions, cls._sessions_pid = {}, os.getpid()
+        statuses = retry_statuses(endpoint)
+        if statuses not in cls._sessions:
+            retry = JitteredRetry(
+                total=WA_MAX_RETRIES,
+                connect=WA_MAX_RETRIES,
+                # a read error means the request may already have been processed, don't risk sending twice
+                read=0,
+                status=WA_MAX_RETRIES,
+                status_forcelist=statuses,
+                allowed_methods=frozenset(['GET', 'POST']),
+                backoff_factor=WA_BACKOFF_FACTOR,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=WA_POOL_SIZE, pool_maxsize=WA_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.headers.update({
+                'accept': "*/*",
+                "Content-Type": "application/json"
+            })
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cls._sessions[statuses] = session
+        return cls._sessions[statuses]
+
+    @staticmethod
+    def log_call(method: str, endpoint: str, status, duration: float, data: dict, text: Optional[str]):
+        # one line per call. full bodies repeat the campaign message for every group, so only a sample is logged
+        logger.info(f" {method} {endpoint} {status} in {duration * 1000:.0f}ms")
+        if logger.isEnabledFor(logging.DEBUG) and random() < LOG_BODY_SAMPLE_RATE:
+            logger.debug(f" {method} {endpoint} payload: {json.dumps(data)} response: {text}")
+
+    @staticmethod
+    def parse_body(status, text: str):
+        # gateways in front of open-wa answer a 502 or 504 with an html page. a body that is not json becomes a failed
+        # response, so it is recorded and counted like any other failure instead of raising
+        try:
+            return json.loads(text)
+        except ValueError:
+            return {'success': False, 'response': None, 'error': f'{status} response is not json: {text[:100]}'}
+
+    def record_call(self, endpoint: str, status, duration: float, resp):
+        record_api_call(endpoint, status, duration, resp)
+        if self.health is not None:
+            self.health.observe(status, duration)
+
+    def send_request(self, endpoint: str, data: dict, method='POST'):
+
+        started = time.monotonic()
+        try:
+            ln = f'{self.base_url}{endpoint}'
+            r = self.session(endpoint).request(method, ln, json=data, timeout=(WA_CONNECT_TIMEOUT, WA_READ_TIMEOUT))
+        except Exception:
+            self.log_call(method, endpoint, 'error', time.monotonic() - started, data, None)
+            self.record_call(endpoint, 'error', time.monotonic() - started, None)
+            raise
+        duration = time.monotonic() - started
+        self.log_call(method, endpoint, r.status_code, duration, data, r.text)
+        resp = self.parse_body(r.status_code, r.text)
+        self.record_call(endpoint, r.status_code, duration, resp)
+        return r.status_code, resp
+
+    def send_text(self, chat_id: str, message: str):
+
+        payload = {
+            'args': {
+                'to': chat_id,
+                'content': message
+            }
+        }
+        return self.send_request(method='POST', endpoint='/sendText', data=payload)
+
+    def join_group(self, link: str):
+
+        payload = {
+            'args': {
+                'link': link,
+                'returnChatObj': 'true'
+            }
+        }
+
+        return self.send_request(method='POST', endpoint='/joinGroupViaLink', data=payload)
+
+    def group_info(self, link: str):
+
+        payload = {
+            'args': {
+                'inviteCode': link
+            }
+        }
+
+        return self.send_request(method='POST', endpoint='/getGroupInfoFromInviteLink', data=payload)
+
+    def leave_group(self, chat_id: str):
+
+        payload = {
+            "args": {
+                "groupId": chat_id
+            }
+        }
+
+        return self.send_request(method='POST', endpoint='/leaveGroup', data=payload)
+
+
+class AsyncWhatsapp(Whatsapp):
+    """
+    asyncio flavour of the client. send_text, join_group and leave_group are inherited and return the coroutine of
+    send_request, so they are awaited the same way: `code, resp = await client.join_group(link)`
+    """
+
+    def __init__(self, url, session: aiohttp.ClientSession, health: 'SessionHealth' = None):
+        super().__init__(url, health)
+        self.http = session
+
+    @staticmethod
+    def create_session() -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_CONCURRENCY),
+            timeout=aiohttp.ClientTimeout(sock_connect=WA_CONNECT_TIMEOUT, sock_read=WA_READ_TIMEOUT),
+            headers={
+                'accept': "*/*",
+                "Content-Type": "application/json"
+            })
+
+    async def send_request(self, endpoint: str, data: dict, method='POST'):
+        ln = f'{self.base_url}{endpoint}'
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        try:
+            # same retry policy as the sync session: failed connects and retry_statuses, never after the request was
+            # sent. ClientConnectorError is only raised while connecting, a dropped connection or a broken response
+            # body may come after open-wa acted on the request
+            statuses = retry_statuses(endpoint)
+            for attempt in range(WA_MAX_RETRIES + 1):
+                try:
+                    async with self.http.request(method, ln, json=data) as r:
+                        status, text = r.status, await r.text()
+                except aiohttp.ClientConnectorError:
+                    if attempt == WA_MAX_RETRIES:
+                        raise
+                else:
+                    if status not in statuses or attempt == WA_MAX_RETRIES:
+                        break
+                await asyncio.sleep(backoff_delay(attempt))
+        except Exception:
+            self.log_call(method, endpoint, 'error', time.monotonic() - started, data, None)
+            await loop.run_in_executor(None, self.record_call, endpoint, 'error', time.monotonic() - started, None)
+            raise
+        duration = time.monotonic() - started
+        self.log_call(method, endpoint, status, duration, data, text)
+        resp = self.parse_body(status, text)
+        await loop.run_in_executor(None, self.record_call, endpoint, status, duration, resp)
+        return status, resp
+
+
+# ------------------------- rate limiting -------------------------
+# token bucket kept in the redis instance RQ already uses. a caller that finds the bucket empty still takes its token
+# (the balance goes negative) and is told how long to wait, so waiting workers are served in order with one round trip.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 60)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+class RateLimiter:
+    _script = None
+
+    def __init__(self, name: str, per_minute: float, burst: int = RATE_BURST, health: 'SessionHealth' = None):
+        self.key = f'ratelimit:{name}'
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        # the configured rate is the ceiling, the session's adaptive scale decides how much of it is used
+        self.health = health
+
+    def reserve(self) -> float:
+        # takes a token and returns how many seconds the caller has to wait before using it
+        if self.rate <= 0:
+            return 0
+        if RateLimiter._script is None:
+            RateLimiter._script = rq.connection.register_script(TOKEN_BUCKET_SCRIPT)
+        rate = self.rate * (self.health.scale() if self.health is not None else 1)
+        return float(RateLimiter._script(keys=[self.key], args=[rate, self.burst, time.time()]))
+
+    def acquire(self, max_wait: float = None) -> float:
+        # sleeps until the token is due. a wait longer than max_wait is returned instead, the token stays taken and
+        # the caller comes back for it then
+        wait = self.reserve()
+        if max_wait is not None and wait > max_wait:
+            return wait
+        if wait > 0:
+            time.sleep(wait)
+        return 0
+
+    async def acquire_async(self):
+        wait = await asyncio.get_running_loop().run_in_executor(None, self.reserve)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+# ------------------------- adaptive control -------------------------
+# every session has a scale between ADAPTIVE_MIN_SCALE and 1 that its rate limits and the async engine's in-flight
+# limit are multiplied by, moved by AIMD on the outcome of every api call, and a circuit breaker. both live in redis, so
+# all workers calling a session share them. an open breaker is a key that expires after BREAKER_COOLDOWN, the calls
+# made after that decide whether it trips again.
+HEALTH_SCRIPT = """
+local now = tonumber(ARGV[1])
+local congested = ARGV[2] == '1'
+local failed = ARGV[3] == '1'
+local increase, decrease, min_scale = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+local window, breaker_window = tonumber(ARGV[7]), tonumber(ARGV[8])
+local min_calls, ratio, cooldown = tonumber(ARGV[9]), tonumber(ARGV[10]), tonumber(ARGV[11])
+local state = redis.call('HMGET', KEYS[1], 'scale', 'decreased_at', 'window_start', 'calls', 'failures')
+local scale = tonumber(state[1]) or 1
+local decreased_at = tonumber(state[2]) or 0
+local window_start = tonumber(state[3]) or now
+local calls = tonumber(state[4]) or 0
+local failures = tonumber(state[5]) or 0
+if now - window_start >= breaker_window then
+    window_start, calls, failures = now, 0, 0
+end
+calls = calls + 1
+if failed then
+    failures = failures + 1
+end
+if congested then
+    -- calls that were already in flight fail together, they only count as one decrease
+    if now - decreased_at >= window then
+        scale = math.max(min_scale, scale * decrease)
+        decreased_at = now
+    end
+else
+    scale = math.min(1, scale + increase)
+end
+local tripped = 0
+if calls >= min_calls and failures / calls >= ratio then
+    redis.call('SET', KEYS[2], '1', 'EX', cooldown)
+    tripped = 1
+    scale = min_scale
+    window_start, calls, failures = now, 0, 0
+end
+redis.call('HSET', KEYS[1], 'scale', scale, 'decreased_at', decreased_at, 'window_start', window_start,
+           'calls', calls, 'failures', failures)
+redis.call('EXPIRE', KEYS[1], 86400)
+return {tostring(scale), tripped}
+"""
+
+
+class SessionHealth:
+    _script = None
+    # seconds a worker reuses what it last read from redis
+    cache_for = 1
+
+    def __init__(self, name: str):
+        self.name = name
+        self.key = f'health:{name}'
+        self.breaker_key = f'breaker:{name}'
+        self._scale, self._scale_read = 1.0, 0
+        self._open_until, self._open_read = 0, 0
+
+    def observe(self, status, duration: float):
+        # called by the client after every api call. metrics style, a redis error never fails the call
+        if not ADAPTIVE_CONTROL:
+            return
+        failed = not isinstance(status, int) or status == 429 or status >= 500
+        congested = failed or duration > ADAPTIVE_LATENCY_TARGET
+        try:
+            if SessionHealth._script is None:
+                SessionHealth._script = rq.connection.register_script(HEALTH_SCRIPT)
+            scale, tripped = SessionHealth._script(keys=[self.key, self.breaker_key], args=[
+                time.time(), int(congested), int(failed), ADAPTIVE_INCREASE, ADAPTIVE_DECREASE, ADAPTIVE_MIN_SCALE,
+                ADAPTIVE_WINDOW, BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATIO, BREAKER_COOLDOWN])
+        except RedisError:
+            logger.warning(" could not update session health", exc_info=True)
+            return
+        self._scale, self._scale_read = float(scale), time.monotonic()
+        if tripped:
+            self._open_until, self._open_read = time.time() + BREAKER_COOLDOWN, time.monotonic()
+            logger.warning(f" circuit breaker of session {self.name} tripped, pausing it for {BREAKER_COOLDOWN}s")
+
+    def refresh(self):
+        # reads the scale and the breaker from redis in one round trip
+        try:
+            pipe = rq.connection.pipeline(transaction=False)
+            pipe.hget(self.key, 'scale')
+            pipe.ttl(self.breaker_key)
+            value, ttl = pipe.execute()
+        except RedisError:
+            value, ttl = None, 0
+        self._scale, self._scale_read = float(value) if value else 1.0, time.monotonic()
+        self._open_until, self._open_read = time.time() + max(0, ttl), time.monotonic()
+
+    def scale(self, refresh: bool = True) -> float:
+        # refresh=False only reads what the worker already has, for the event loop that must not wait on redis
+        if not ADAPTIVE_CONTROL:
+            return 1.0
+        if refresh and time.monotonic() - self._scale_read > self.cache_for:
+            self.refresh()
+        return self._scale
+
+    def open_for(self, refresh: bool = True) -> float:
+        # seconds until the circuit breaker closes, 0 when calls may go out
+        if not ADAPTIVE_CONTROL:
+            return 0
+        if refresh and time.monotonic() - self._open_read > self.cache_for:
+            self.refresh()
+        return max(0.0, self._open_until - time.time())
+
+    async def watch(self):
+        # keeps the cached scale and breaker fresh for an event loop, the redis calls run on the default executor
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.cache_for)
+            await loop.run_in_executor(None, self.refresh)
+
+
+class AdaptiveLimit:
+    # asyncio semaphore for the async engine whose size follows the session's scale, between 1 and limit
+
+    def __init__(self, limit: int, health: SessionHealth):
+        self.limit = limit
+        self.health = health
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    def size(self) -> int:
+        # the cached scale, SessionHealth.watch keeps it fresh
+        return max(1, int(self.limit * self.health.scale(refresh=False)))
+
+    async def __aenter__(self):
+        async with self.condition:
+            while self.in_flight >= self.size():
+                try:
+                    # the size can grow without anything being released, so it is looked at again every second
+                    await asyncio.wait_for(self.condition.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+
+# ------------------------- session pool -------------------------
+# every open-wa session in WA_SESSIONS is a separate phone number with its own rate budget, so campaigns are split
+# into one shard per session and throughput grows with the number of sessions.
+
+class WaSession:
+    def __init__(self, name: str, url: str, weight: float = 1, joins_per_minute: float = RATE_JOINS_PER_MINUTE,
+                 sends_per_minute: float = RATE_SENDS_PER_MINUTE, leaves_per_minute: float = RATE_LEAVES_PER_MINUTE,
+                 checks_per_minute: float = RATE_CHECKS_PER_MINUTE, burst: int = RATE_BURST):
+        self.name = name
+        self.url = url
+        self.weight = float(weight)
+        self.health = SessionHealth(name)
+        self.client = Whatsapp(url, self.health)
+        self.limiters = {
+            'join': RateLimiter(f'{name}:join', joins_per_minute, burst, self.health),
+            'send': RateLimiter(f'{name}:send', sends_per_minute, burst, self.health),
+            'leave': RateLimiter(f'{name}:leave', leaves_per_minute, burst, self.health),
+            'check': RateLimiter(f'{name}:check', checks_per_minute, burst, self.health),
+        }
+
+    def __repr__(self):
+        return f'<WaSession {self.name} {self.url}>'
+
+
+wa_sessions = [WaSession(**config) for config in WA_SESSIONS]
+sessions_by_name = {session.name: session for session in wa_sessions}
+
+
+def get_session(name: str = None) -> WaSession:
+    # unknown or missing names fall back to the first session, the one that used to be API_BASE_URL
+    return sessions_by_name.get(name) or wa_sessions[0]
+
+
+def session_for(link: GroupLink) -> WaSession:
+    """
+    the session that handles a link. a group stays with the session that joined it (groups joined before sessions were
+    configured belong to the first session), every other group is placed by weighted rendezvous hashing of its id. the
+    choice only depends on the link itself, so shard jobs streaming the same links agree on the split without talking
+    to each other, and a weight 0 session keeps its groups but gets no new ones
+    """
+    if link.chat_id:
+        session = sessions_by_name.get(link.wa_session) if link.wa_session else wa_sessions[0]
+        if session is not None:
+            return session
+    return max(wa_sessions, key=lambda candidate: rendezvous_score(candidate, link.id))
+
+
+def rendezvous_score(session: WaSession, link_id: int) -> float:
+    if session.weight <= 0:
+        return float('-inf')
+    digest = int(hashlib.md5(f'{session.name}:{link_id}'.encode()).hexdigest()[:13], 16)
+    return -session.weight / math.log((digest + 1) / (16 ** 13 + 1))
+
+
+def partition_links(links_list: List[GroupLink]) -> dict:
+    # splits links into {session name: [links]}
+    shards = {}
+    for link in links_list:
+        shards.setdefault(session_for(link).name, []).append(link)
+    return shards
+
+
+# ------------------------- group membership -------------------------
+# chat id of every group a session joined, keyed by session name and GroupLink.id, kept in redis for MEMBERSHIP_TTL. a
+# hit means the join call can be skipped. entries are dropped when we leave the group or a send to it fails.
+
+def membership_key(session: str, link_id: int):
+    return f'membership:{session}:{link_id}'
+
+
+def cached_chat_id(session: str, link_id: int) -> Optional[str]:
+    chat_id = rq.connection.get(membership_key(session, link_id))
+    return chat_id.decode() if chat_id else None
+
+
+def cached_chat_ids(session: str, link_ids: List[int]) -> dict:
+    chat_ids = {}
+    for chunk in chunked(link_ids, MESSAGE_INSERT_CHUNK_SIZE):
+        keys = [membership_key(session, link_id) for link_id in chunk]
+        for link_id, chat_id in zip(chunk, rq.connection.mget(keys)):
+            if chat_id:
+                chat_ids[link_id] = chat_id.decode()
+    return chat_ids
+
+
+def remember_membership(session: str, link_id: int, chat_id: str):
+    rq.connection.set(membership_key(session, link_id), chat_id, ex=MEMBERSHIP_TTL)
+
+
+def forget_membership(session: str, link_id: int):
+    rq.connection.delete(membership_key(session, link_id))
+
+
+@rq.job('join', timeout=STEP_JOB_TIMEOUT)
+def join_group(link_id: int, message_id: int, reserved: bool = False, **kwargs):
+    with log_context(link=link_id, message=message_id):
+        group_link = db.session.get(GroupLink, link_id)
+        message = db.session.get(Message, message_id)
+        if message.message_send_succeeded:
+            logger.info(f" {group_link.link} already got the message in this campaign, skipping")
+            return
+        session = session_for(group_link)
+        paused = session.health.open_for()
+        if paused:
+            join_group.schedule(timedelta(seconds=paused), link_id, message_id, reserved=reserved)
+            return
+        logger.info(f" processing join group for {group_link.link} on {session.name}")
+        if group_link.chat_id and cached_chat_id(session.name, link_id) == group_link.chat_id:
+            logger.info(f" already a member of {group_link.chat_id}, skipping join")
+            message.join_succeeded = True
+            group_link.joined_at = datetime.now()
+            db.session.commit()
+            count_progress(message.campaign_id, joined=1)
+            send_msg_to_group.queue(link_id, message_id)
+            return
+        wait = 0 if reserved else session.limiters['join'].acquire(RATE_MAX_WAIT)
+        if wait:
+            join_group.schedule(timedelta(seconds=wait), link_id, message_id, reserved=True)
+            return
+        logger.info("joining group")
+        started = time.monotonic()
+        try:
+            code, join_resp = session.client.join_group(group_link.link)
+        except (requests.RequestException, ValueError) as e:
+            # e.g. no answer within WA_READ_TIMEOUT. the group fails, a rerun of the campaign tries it again
+            fail_chain_step(message, 'join', e, time.monotonic() - started)
+            return
+        if code == 200 and join_resp["success"] and isinstance(join_resp['response'], dict):
+            group_chat_id: str = join_resp["response"].get('id')
+            group_name: str = join_resp["response"].get('name')
+            logger.info(f" successfully joined group with id: {group_chat_id}")
+            db.session.add(MessageStep(**step_outcome(
+                message_id, 'join', code, join_resp, time.monotonic() - started, bool(group_chat_id), group_chat_id)))
+            if group_chat_id:
+                message.join_succeeded = True
+                for name, value in link_join_fields(group_link.failure_count, code, True).items():
+                    setattr(group_link, name, value)
+                group_link.chat_id = group_chat_id
+                group_link.name = group_name
+                group_link.wa_session = session.name
+                group_link.joined_at = datetime.now()
+                db.session.commit()
+                remember_membership(session.name, link_id, group_chat_id)
+                count_progress(message.campaign_id, joined=1)
+
+                # queue sending message, the send budget paces it
+                send_msg_to_group.queue(link_id, message_id)
+                logger.info(f" ⏲ queued sending message to {group_link.name}")
+            else:
+                group_link.chat_id = None
+                db.session.commit()
+        else:
+            message.join_succeeded = False
+            db.session.add(MessageStep(**step_outcome(
+                message_id, 'join', code, join_resp, time.monotonic() - started, False)))
+            for name, value in link_join_fields(group_link.failure_count, code, False).items():
+                setattr(group_link, name, value)
+            group_link.chat_id = None
+            db.session.commit()
+            count_progress(message.campaign_id, failed=1)
+
+
+@rq.job('send', timeout=STEP_JOB_TIMEOUT)
+def send_msg_to_group(link_id: int, message_id: int, reserved: bool = False, **kwargs):
+    with log_context(link=link_id, message=message_id):
+        group_link = db.session.get(GroupLink, link_id)
+        message = db.session.get(Message, message_id)
+        text = db.session.get(Campaign, message.campaign_id).message
+        session = get_session(group_link.wa_session)
+        paused = session.health.open_for()
+        if paused:
+            send_msg_to_group.schedule(timedelta(seconds=paused), link_id, message_id, reserved=reserved)
+            return
+        logger.info(f" processing send message for {group_link.link} ")
+        if group_link.chat_id is not None and message.join_succeeded and not message.message_send_succeeded:
+            wait = 0 if reserved else session.limiters['send'].acquire(RATE_MAX_WAIT)
+            if wait:
+                send_msg_to_group.schedule(timedelta(seconds=wait), link_id, message_id, reserved=True)
+                return
+            logger.info(f" sending message to {group_link.name}...")
+            started = time.monotonic()
+            try:
+                send_code, send_resp = session.client.send_text(
+                    chat_id=group_link.chat_id, message=text)
+            except (requests.RequestException, ValueError) as e:
+                fail_chain_step(message, 'send', e, time.monotonic() - started, group_link.chat_id)
+                return
+            sent = bool(send_code == 200 and send_resp['response'])
+            db.session.add(MessageStep(**step_outcome(
+                message_id, 'send', send_code, send_resp, time.monotonic() - started, sent, group_link.chat_id)))
+            if sent:
+                message.message_send_succeeded = True
+                db.session.commit()
+                count_progress(message.campaign_id, sent=1)
+                logger.info("successfully sent message to group")
+            else:
+                message.message_send_succeeded = False
+                db.session.commit()
+                forget_membership(session.name, link_id)
+                count_progress(message.campaign_id, failed=1)
+                logger.info("Message sending did not succeed")
+
+
+def fail_chain_step(message: Message, step: str, error: Exception, duration: float, chat_id: str = None):
+    # job chain twin of MessageBuffer.record_failed_call
+    logger.warning(f" {step} failed: {error!r}")
+    db.session.add(MessageStep(**step_outcome(
+        message.id, step, None, {'error': repr(error)}, duration, False, chat_id)))
+    setattr(message, 'join_succeeded' if step == 'join' else 'message_send_succeeded', False)
+    db.session.commit()
+    count_progress(message.campaign_id, failed=1)
+
+
+@rq.job('leave')
+def leave_group(link_id: int, message_id: int = None, **kwargs):
+    # leaves one group right away. campaigns no longer queue this, sweep_leaves leaves groups in batches
+    with log_context(link=link_id):
+        group_link = db.session.get(GroupLink, link_id)
+        if group_link.chat_id and group_link.joined_at:
+            leave_link(group_link)
+
+
+@rq.job('campaign')
+def campaign_task(campaign_id, id_ranges: List[tuple] = None, engine: str = None, session: str = None,
+                  run: str = None, **kwargs):
+    """
+    sample success response:
+
+    {
+        "success": true,
+        "response": {
+            "id": "120363042118385076@g.us",
+            "lastReceivedKey": {
+                "fromMe": false,
+                "remote": {
+                    "server": "g.us",
+                    "user": "120363042118385076",
+                    "_serialized": "120363042118385076@g.us"
+                },
+                "id": "3EB09228CB1C1ABF7B25",
+                "_serialized": "false_120363042118385076@g.us_3EB09228CB1C1ABF7B25"
+                },
+                "unreadCount": 0,
+                "muteExpiration": 0,
+                "hasUnreadMention": false,
+                "archiveAtMentionViewedInDrawer": false,
+                "hasChatBeenOpened": false,
+                "pendingInitialLoading": false,
+                "msgs": null,
+                "kind": "group",
+                "canSend": true,
+                "isGroup": true,
+                "contact": {
+                "id": "120363042118385076@g.us",
+                "type": "in",
+                "formattedName": "",
+                "isMe": false,
+                "isMyContact": false,
+                "isPSA": false,
+                "isUser": false,
+                "isWAContact": false,
+                "profilePicThumbObj": {
+                    "id": "120363042118385076@g.us",
+                    "img": null,
+                    "imgFull": null
+                },
+                "msgs": null
+                },
+                "groupMetadata": {
+                    "id": "120363042118385076@g.us",
+                    "suspended": false,
+                    "terminated": false,
+                    "uniqueShortNameMap": {},
+                    "participants": [],
+                    "pendingParticipants": [],
+                    "pastParticipants": [],
+                    "membershipApprovalRequests": []
+                },
+                "presence": {
+                "id": {
+                    "server": "g.us",
+                    "user": "120363042118385076",
+                    "_serialized": "120363042118385076@g.us"
+                },
+                "chatstates": []
+            },
+            "isOnline": false,
+            "participantsCount": 1
+        }
+    }
+    """
+    with log_context(campaign=campaign_id, session=session):
+        # the job only carries ids. links are streamed from the database CAMPAIGN_CHUNK_SIZE at a time and every chunk
+        # is worked through before the next one is read. id_ranges=None means every active link
+        message = db.session.get(Campaign, campaign_id).message
+        engine = engine or CAMPAIGN_ENGINE
+
+        if session is None:
+            # the campaign job queues one shard job per session, so every phone number works through its own groups
+            # at its own pace. every shard streams the links and keeps the ones session_for gives it. with a single
+            # session the campaign job runs the only shard itself. the shard locks are taken here, before anything
+            # is reset, so a campaign that is still running is not started a second time
+            run = uuid.uuid4().hex
+            if not claim_run_locks(campaign_id, [wa_session.name for wa_session in wa_sessions], run):
+                logger.info(" campaign is already running, not starting it again")
+                return
+            already_sent = count_sent_links(campaign_id)
+            if already_sent:
+                logger.info(f" resuming, {already_sent} groups already have the message")
+            start_progress(campaign_id, count_campaign_links(campaign_id, id_ranges))
+            mark_campaign_started(campaign_id)
+            if len(wa_sessions) > 1:
+                rq.connection.set(campaign_key(campaign_id, 'shards'), len(wa_sessions))
+                for wa_session in wa_sessions:
+                    campaign_task.queue(campaign_id, id_ranges, engine, session=wa_session.name, run=run,
+                                        timeout=CAMPAIGN_TIMEOUT)
+                logger.info(f" split over sessions {', '.join(wa_session.name for wa_session in wa_sessions)}")
+                return
+            rq.connection.delete(campaign_key(campaign_id, 'shards'))
+            session = wa_sessions[0].name
+        elif not RunLock(campaign_id, session).claim(run):
+            logger.info(f" shard on {session} is already running, skipping it")
+            return
+        wa_session = get_session(session)
+        lock = RunLock(campaign_id, session)
+        rq.connection.hdel(progress_key(campaign_id), f'paused_until:{wa_session.name}')
+        try:
+            with lock.heartbeat():
+                paused = run_shard(campaign_id, id_ranges, engine, wa_session, message)
+        except BaseException:
+            # a failed run must not keep resume_stalled_campaigns away for CAMPAIGN_LOCK_TTL
+            lock.release()
+            raise
+        if paused:
+            pause_shard(campaign_id, id_ranges, engine, wa_session.name, paused, run)
+        elif engine != 'fanout':
+            finish_shard(campaign_id, wa_session.name)
+
+
+def run_shard(campaign_id, id_ranges: List[tuple], engine: str, wa_session: WaSession, message: str) -> float:
+    # works through the shard's links with the given engine. returns the seconds the session's circuit breaker stays
+    # open when it stopped the run, 0 otherwise. a fan-out shard only starts its job chain, the chain finishes it
+    if engine == 'async':
+        return asyncio.run(run_campaign_async(pending_link_chunks(campaign_id, id_ranges, wa_session), message,
+                                              campaign_id, wa_session))
+    chunks = campaign_link_chunks(campaign_id, id_ranges, wa_session)
+    if engine == 'fanout':
+        fan_out_campaign(((link.id, msg_id) for chunk in chunks for link, msg_id in chunk), campaign_id,
+                         wa_session.name)
+        return 0
+
+    buffer = MessageBuffer(campaign_id)
+    paused = 0
+    try:
+        for link, msg_id in itertools.chain.from_iterable(chunks):
+            paused = wa_session.health.open_for()
+            if paused:
+                break
+            """ uncomment the code below and comment the other remaining part to schedule all events. schedule events means,
+            for example, 
+            after joining a group, a new event to send message to that group is scheduled. and after sucessfully sending, a new event to leave group is scheduled.
+            this means, once an event has been scheduled, the code will continue running and processing other events that were scheduled before. that means, you
+            could see in your whatsapp, the bot sending a message to one group, leaving other 2 joining other 3 group... leving others sending to others... events
+            seem kinda random. but it's good since if one event fails, for example if a message is not sent, the bot will not leave the group since that event will 
+            not be scheduled """
+            # join_group.queue(link.id, msg_id)
+            # logger.info(f" queued {link.link}, the join budget paces it")
+
+            # join group
+
+            """if you uncomment the code above, then you should comment everythng else on this function below this quote. When uncommented as it is, the bot
+            will perform actions in the same order. join one group, send message, then leave....only then will it go to the next group. if an error occurs it will
+            stop there for the group. NOTE:  with this setup, tests we did showed the bot could join a group, and leave without sending the message"""
+            with log_context(link=link.id):
+                process_group_link(wa_session, link, msg_id, message, buffer)
+    finally:
+        buffer.flush()
+    return paused
+
+
+def campaign_links_select(*entities):
+    # the links a campaign goes out to: active, not quarantined and not backing off after a failed join
+    return db.select(*(entities or (GroupLink,))).filter_by(active=True, quarantined_at=None).where(
+        or_(GroupLink.next_attempt_at.is_(None), GroupLink.next_attempt_at <= datetime.now()))
+
+
+def link_join_fields(failure_count: Optional[int], code, joined: bool) -> dict:
+    # GroupLink failure tracking fields to write after a join attempt or invite check, {} when nothing changes.
+    # server errors, 429s and network errors say nothing about the link and are not counted
+    if joined:
+        return {'failure_count': 0, 'next_attempt_at': None} if failure_count else {}
+    if code is None or code >= 500 or code == 429:
+        return {}
+    failures = (failure_count or 0) + 1
+    backoff = min(LINK_RETRY_BACKOFF_MAX, LINK_RETRY_BACKOFF * 2 ** (failures - 1))
+    fields = {'failure_count': failures, 'next_attempt_at': datetime.now() + timedelta(seconds=backoff)}
+    if failures >= LINK_MAX_FAILURES:
+        logger.info(f" quarantining link after {failures} failed joins in a row")
+        fields['quarantined_at'] = datetime.now()
+    return fields
+
+
+def compact_ranges(ids: List[int]) -> List[tuple]:
+    # sorted ids -> inclusive (first, last) ranges, [1, 2, 3, 7, 8] -> [(1, 3), (7, 8)]. keeps job payloads small
+    ranges = []
+    for id_ in ids:
+        if ranges and ranges[-1][1] == id_ - 1:
+            ranges[-1] = (ranges[-1][0], id_)
+        else:
+            ranges.append((id_, id_))
+    return ranges
+
+
+def chunked(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def chunked_iter(items, size: int):
+    # chunked for iterators and generators
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def in_ranges(id_: int, id_ranges: List[tuple]) -> bool:
+    # id_ranges as made by compact_ranges. a long list of ranges is checked here rather than in the query, an OR per
+    # range can go past the database's expression limits
+    i = bisect.bisect_right(id_ranges, (id_, float('inf'))) - 1
+    return i >= 0 and id_ranges[i][0] <= id_ <= id_ranges[i][1]
+
+
+def stream_links(id_ranges: List[tuple] = None):
+    """
+    yields the campaign's links in id order, CAMPAIGN_CHUNK_SIZE at a time. every chunk is a short keyset query of its
+    own instead of one cursor held open for the whole campaign, so the worker can commit between chunks. the links are
+    detached from the session, commits would otherwise expire them and reload every row one by one
+    """
+    if id_ranges is not None and not id_ranges:
+        return
+    after = None
+    while True:
+        query = campaign_links_select().order_by(GroupLink.id).limit(CAMPAIGN_CHUNK_SIZE)
+        if id_ranges:
+            query = query.where(GroupLink.id.between(id_ranges[0][0], id_ranges[-1][1]))
+        if after is not None:
+            query = query.where(GroupLink.id > after)
+        chunk = db.session.execute(query).scalars().all()
+        for link in chunk:
+            db.session.expunge(link)
+        selected = chunk if id_ranges is None else [link for link in chunk if in_ranges(link.id, id_ranges)]
+        if selected:
+            yield selected
+        if len(chunk) < CAMPAIGN_CHUNK_SIZE:
+            return
+        after = chunk[-1].id
+
+
+def pending_link_chunks(campaign_id, id_ranges: List[tuple], wa_session: WaSession):
+    # streamed chunks of the links this session handles that have not got the message yet
+    for chunk in stream_links(id_ranges):
+        chunk = [link for link in chunk if session_for(link) is wa_session]
+        if chunk:
+            already_sent = sent_link_ids(campaign_id, [link.id for link in chunk])
+            chunk = [link for link in chunk if link.id not in already_sent]
+        if chunk:
+            yield chunk
+
+
+def with_message_ids(campaign_id, links_list: List[GroupLink]) -> List[tuple]:
+    message_ids = create_campaign_messages(campaign_id, [link.id for link in links_list])
+    return [(link, message_ids[link.id]) for link in links_list]
+
+
+def campaign_link_chunks(campaign_id, id_ranges: List[tuple], wa_session: WaSession):
+    # [(link, message id)] per pending chunk, the invite pre-check and the message rows are done a chunk at a time
+    for chunk in pending_link_chunks(campaign_id, id_ranges, wa_session):
+        if PREFLIGHT_INVITE_CHECK:
+            chunk = check_invite_links(chunk, campaign_id)
+        if chunk:
+            yield with_message_ids(campaign_id, chunk)
+
+
+def count_campaign_links(campaign_id, id_ranges: List[tuple] = None) -> int:
+    # groups a run of the campaign still has to go through, for the progress total
+    not_sent = GroupLink.id.notin_(db.select(Message.group_link).where(
+        Message.campaign_id == campaign_id, Message.message_send_succeeded.is_(True)))
+    if id_ranges is None:
+        return db.session.execute(campaign_links_select(func.count(GroupLink.id)).where(not_sent)).scalar()
+    if not id_ranges:
+        return 0
+    link_ids = db.session.execute(campaign_links_select(GroupLink.id).where(
+        not_sent, GroupLink.id.between(id_ranges[0][0], id_ranges[-1][1]))).scalars()
+    return sum(1 for link_id in link_ids if in_ranges(link_id, id_ranges))
+
+
+# ------------------------- message persistence -------------------------
+
+def create_campaign_messages(campaign_id, link_ids: List[int]) -> dict:
+    # one multi-row insert per chunk instead of an insert + commit + refresh per group. links that already have a row
+    # in this campaign keep it, that row is the checkpoint a resumed run continues from. returns {link id: message id}
+    now = datetime.now()
+    message_ids = {}
+    for chunk in chunked(link_ids, MESSAGE_INSERT_CHUNK_SIZE):
+        existing = set(db.session.execute(db.select(Message.group_link).where(
+            Message.campaign_id == campaign_id, Message.group_link.in_(chunk))).scalars())
+        missing = [link_id for link_id in chunk if link_id not in existing]
+        if missing:
+            db.session.execute(db.insert(Message).values(
+                [{'campaign_id': campaign_id, 'group_link': link_id, 'sent_at': now} for link_id in missing]))
+        message_ids.update(db.session.execute(db.select(Message.group_link, Message.id).where(
+            Message.campaign_id == campaign_id, Message.group_link.in_(chunk))).all())
+    db.session.commit()
+    return message_ids
+
+
+def sent_link_ids(campaign_id, link_ids: List[int]) -> set:
+    return set(db.session.execute(db.select(Message.group_link).where(
+        Message.campaign_id == campaign_id, Message.group_link.in_(link_ids),
+        Message.message_send_succeeded.is_(True))).scalars())
+
+
+def count_sent_links(campaign_id) -> int:
+    return db.session.execute(db.select(func.count(Message.id)).where(
+        Message.campaign_id == campaign_id, Message.message_send_succeeded.is_(True))).scalar()
+
+
+def response_error(resp) -> Optional[str]:
+    # short error out of an open-wa failure response, the full response only goes into the step payload
+    error = resp.get('error') or resp.get('response') if isinstance(resp, dict) else resp
+    if isinstance(error, dict):
+        error = error.get('message') or error.get('code')
+    if error is None or isinstance(error, bool) or error == '':
+        return None
+    return str(error)[:100]
+
+
+def step_outcome(message_id: int, step: str, code, resp, duration: float, success: bool,
+                 chat_id: str = None) -> dict:
+    # MessageStep row for one api call, code is None when the call failed before an http response
+    payload = None
+    if STEP_PAYLOADS == 'all' or (STEP_PAYLOADS == 'errors' and not success):
+        payload = zlib.compress(json.dumps(resp).encode())
+    return {
+        'message_id': message_id,
+        'step': step,
+        'status_code': code,
+        'success': bool(success),
+        'chat_id': chat_id,
+        'error': None if success else response_error(resp),
+        'duration_ms': round(duration * 1000),
+        'created_at': datetime.now(),
+        'payload': payload,
+    }
+
+
+class MessageBuffer:
+    """
+    write-behind buffer for Message outcomes, their MessageStep records and the chat id / name learnt for a GroupLink
+    on join. updates are merged per row and written with one bulk statement each once MESSAGE_FLUSH_SIZE rows are
+    pending or MESSAGE_FLUSH_INTERVAL seconds have passed, so a crash loses at most one flush window. with autoflush
+    off the owner decides when to flush, e.g. to write from another thread
+    """
+
+    def __init__(self, campaign_id=None, autoflush=True):
+        self.campaign_id = campaign_id
+        self.autoflush = autoflush
+        self.pending = {}
+        self.pending_links = {}
+        self.pending_steps = []
+        self.last_flush = time.monotonic()
+
+    def update(self, message_id: int, **fields):
+        self.pending.setdefault(message_id, {'id': message_id}).update(fields, updated=datetime.now())
+        if self.autoflush and self.due():
+            self.flush()
+
+    def update_link(self, link_id: int, **fields):
+        if not fields:
+            return
+        self.pending_links.setdefault(link_id, {'id': link_id}).update(fields)
+
+    def record_step(self, message_id: int, step: str, code, resp, duration: float, success: bool,
+                    chat_id: str = None):
+        self.pending_steps.append(step_outcome(message_id, step, code, resp, duration, success, chat_id))
+
+    def record_failed_call(self, message_id: int, step: str, error: Exception, duration: float, chat_id: str = None):
+        # an api call that raised, e.g. a timeout. it fails the step it was made for and nothing else
+        logger.warning(f" {step} failed: {error!r}")
+        self.record_step(message_id, step, None, {'error': repr(error)}, duration, False, chat_id)
+        self.update(message_id, **{'join_succeeded' if step == 'join' else 'message_send_succeeded': False})
+
+    def due(self) -> bool:
+        return len(self.pending) >= MESSAGE_FLUSH_SIZE or time.monotonic() - self.last_flush >= MESSAGE_FLUSH_INTERVAL
+
+    def take(self) -> tuple:
+        rows, link_rows, step_rows = list(self.pending.values()), list(self.pending_links.values()), self.pending_steps
+        self.pending, self.pending_links, self.pending_steps = {}, {}, []
+        self.last_flush = time.monotonic()
+        return rows, link_rows, step_rows
+
+    def flush(self):
+        save_message_updates(*self.take(), campaign_id=self.campaign_id)
+
+
+def save_message_updates(rows: List[dict], link_rows: List[dict] = (), step_rows: List[dict] = (), campaign_id=None):
+    if rows or link_rows or step_rows:
+        db.session.bulk_update_mappings(Message, rows)
+        db.session.bulk_update_mappings(GroupLink, link_rows)
+        if step_rows:
+            db.session.execute(db.insert(MessageStep).values(step_rows))
+        db.session.commit()
+        # progress counters follow the flushes, so they trail the api calls by at most one flush window
+        count_progress(
+            campaign_id,
+            joined=sum(row.get('join_succeeded') is True for row in rows),
+            sent=sum(row.get('message_send_succeeded') is True for row in rows),
+            failed=sum(row.get('join_succeeded') is False or row.get('message_send_succeeded') is False
+                       for row in rows))
+
+
+@rq.job('default')
+def purge_step_payloads(**kwargs):
+    # raw responses older than STEP_PAYLOAD_RETENTION_DAYS are dropped, the compact step records stay
+    cutoff = datetime.now() - timedelta(days=STEP_PAYLOAD_RETENTION_DAYS)
+    steps = db.session.execute(db.update(MessageStep).where(
+        MessageStep.created_at < cutoff, MessageStep.payload.isnot(None)).values(payload=None)).rowcount
+    messages = db.session.execute(db.update(Message).where(
+        Message.sent_at < cutoff, Message.response_dump.isnot(None)).values(response_dump=None)).rowcount
+    db.session.commit()
+    logger.info(f" purged {steps} step payloads and {messages} message response dumps older than {cutoff}")
+
+
+def process_group_link(session: WaSession, link: GroupLink, msg_id: int, message: str, buffer: MessageBuffer,
+                       max_wait: float = None, reserved: str = None) -> Optional[tuple]:
+    # join -> send pipeline for a single group through one session. used by the sequential loop in campaign_task and
+    # by the per-group jobs of the fan-out engine. groups are left later by sweep_leaves. a step whose rate token is
+    # more than max_wait seconds away is not run, (step, wait) is returned and the caller runs the group again once
+    # the wait is over with reserved=step, the token is held for it
+    whatsapp = session.client
+    group_chat_id = cached_chat_id(session.name, link.id)
+    if group_chat_id:
+        logger.info(f"already a member of {group_chat_id}, skipping join")
+        # a deferred send's join was recorded by the run that put it off
+        if reserved != 'send':
+            buffer.update(msg_id, join_succeeded=True)
+            buffer.update_link(link.id, joined_at=datetime.now())
+    else:
+        wait = 0 if reserved == 'join' else session.limiters['join'].acquire(max_wait)
+        if wait:
+            return 'join', wait
+        started = time.monotonic()
+        try:
+            code, join_resp = whatsapp.join_group(link.link)
+        except (requests.RequestException, ValueError) as e:
+            # the client already told the session's health about it. only this group fails, the campaign carries on
+            # and stops at the next group if that tripped the circuit breaker
+            buffer.record_failed_call(msg_id, 'join', e, time.monotonic() - started)
+            return
+        if code == 200 and join_resp["success"]:
+            group_chat_id = join_resp["response"]["id"]
+            logger.info(f"successfully joined group with id: {group_chat_id}")
+            buffer.record_step(msg_id, 'join', code, join_resp, time.monotonic() - started, True, group_chat_id)
+            buffer.update(msg_id, join_succeeded=True)
+            buffer.update_link(link.id, chat_id=group_chat_id, name=join_resp["response"].get('name'),
+                               wa_session=session.name, joined_at=datetime.now(),
+                               **link_join_fields(link.failure_count, code, True))
+            if group_chat_id.endswith('@g.us'):
+                remember_membership(session.name, link.id, group_chat_id)
+        else:
+            logger.info("joining group DID NOT SUCCEED")
+            buffer.record_step(msg_id, 'join', code, join_resp, time.monotonic() - started, False)
+            buffer.update_link(link.id, **link_join_fields(link.failure_count, code, False))
+            buffer.update(msg_id, join_succeeded=False)
+            return
+
+    if group_chat_id.endswith('@g.us'):
+
+        # send message
+        wait = 0 if reserved == 'send' else session.limiters['send'].acquire(max_wait)
+        if wait:
+            return 'send', wait
+        started = time.monotonic()
+        try:
+            send_code, send_resp = whatsapp.send_text(
+                chat_id=group_chat_id, message=message)
+        except (requests.RequestException, ValueError) as e:
+            buffer.record_failed_call(msg_id, 'send', e, time.monotonic() - started, group_chat_id)
+            return
+        sent = bool(send_code == 200 and send_resp['success'])
+        buffer.record_step(msg_id, 'send', send_code, send_resp, time.monotonic() - started, sent, group_chat_id)
+        buffer.update(msg_id, message_send_succeeded=sent)
+        if sent:
+            logger.info("successfully sent message to group")
+        else:
+            forget_membership(session.name, link.id)
+            logger.info(f"message sending DID NOT SUCCEED: {response_error(send_resp)}")
+    else:
+        logger.info("malformed link")
+
+
+# ------------------------- async engine -------------------------
+# one event loop keeps up to ASYNC_CONCURRENCY groups in flight. results go into a MessageBuffer that is flushed from a
+# single background thread, so the loop never blocks on the database.
+
+async def run_campaign_async(chunks, message: str, campaign_id, wa_session: WaSession) -> float:
+    """
+    chunks are lists of links as made by pending_link_chunks. the next chunk is only read once fewer than
+    CAMPAIGN_CHUNK_SIZE groups are waiting, so a big campaign never has all its groups scheduled at once. returns the
+    seconds the session's circuit breaker stays open when it stopped the run, 0 when every group was processed
+    """
+    loop = asyncio.get_running_loop()
+    app = current_app._get_current_object()
+    limit = AdaptiveLimit(ASYNC_CONCURRENCY, wa_session.health)
+    paused = 0
+    executor = ThreadPoolExecutor(max_workers=1)
+    buffer = MessageBuffer(campaign_id, autoflush=False)
+
+    def db_call(fn, *args):
+        # database and redis round trips run on the db thread, a blocking call on the loop would stall every group
+        # in flight. the log context goes along
+        return loop.run_in_executor(executor, contextvars.copy_context().run, call_in_app_context, app, fn, *args)
+
+    async def flush():
+        await db_call(save_message_updates, *buffer.take(), campaign_id)
+
+    async with AsyncWhatsapp.create_session() as session:
+        client = AsyncWhatsapp(wa_session.url, session, wa_session.health)
+
+        async def run_one(link_id: int, link_url: str, msg_id: int, failure_count: int, group_chat_id: str):
+            # every group runs in its own task with its own copy of the context, so the link id stays with this group
+            nonlocal paused
+            async with limit:
+                paused = paused or wa_session.health.open_for(refresh=False)
+                if paused:
+                    # left for the run that picks the campaign up again
+                    return
+                with log_context(link=link_id):
+                    await process_group_link_async(wa_session, client, link_id, link_url, msg_id, message, buffer,
+                                                   group_chat_id, failure_count)
+            if buffer.due():
+                await flush()
+
+        async def wait(tasks: set, return_when) -> set:
+            done, tasks = await asyncio.wait(tasks, return_when=return_when)
+            for task in done:
+                # re-raises what a group did not handle itself
+                task.result()
+            return tasks
+
+        # the loop only reads the cached health of the session, a background task refreshes it
+        await loop.run_in_executor(None, wa_session.health.refresh)
+        watcher = asyncio.ensure_future(wa_session.health.watch())
+        tasks = set()
+        try:
+            while not paused:
+                chunk = await db_call(next, chunks, None)
+                if chunk is None:
+                    break
+                if PREFLIGHT_INVITE_CHECK:
+                    dead = await find_dead_invite_links(chunk)
+                    await db_call(save_dead_invite_links, dead, campaign_id)
+                    chunk = [link for link in chunk if link.id not in dead]
+                if not chunk:
+                    continue
+                memberships = await db_call(cached_chat_ids, wa_session.name, [link.id for link in chunk])
+                for link, msg_id in await db_call(with_message_ids, campaign_id, chunk):
+                    tasks.add(asyncio.ensure_future(run_one(link.id, link.link, msg_id, link.failure_count,
+                                                            memberships.get(link.id))))
+                while len(tasks) >= CAMPAIGN_CHUNK_SIZE:
+                    tasks = await wait(tasks, asyncio.FIRST_COMPLETED)
+            if tasks:
+                await wait(tasks, asyncio.ALL_COMPLETED)
+        finally:
+            watcher.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(watcher, *tasks, return_exceptions=True)
+            await flush()
+    executor.shutdown()
+    return paused
+
+
+async def process_group_link_async(wa_session: WaSession, client: AsyncWhatsapp, link_id: int, link_url: str,
+                                   msg_id: int, message: str, buffer: MessageBuffer, group_chat_id: str = None,
+                                   failure_count: int = 0):
+    # async twin of process_group_link. group_chat_id is the cached membership, if any
+    loop = asyncio.get_running_loop()
+    limiters = wa_session.limiters
+    if group_chat_id:
+        logger.info(f"already a member of {group_chat_id}, skipping join")
+        buffer.update(msg_id, join_succeeded=True)
+        buffer.update_link(link_id, joined_at=datetime.now())
+    else:
+        await limiters['join'].acquire_async()
+        started = time.monotonic()
+        try:
+            code, join_resp = await client.join_group(link_url)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            buffer.record_failed_call(msg_id, 'join', e, time.monotonic() - started)
+            return
+        if code == 200 and join_resp["success"]:
+            group_chat_id = join_resp["response"]["id"]
+            logger.info(f"successfully joined group with id: {group_chat_id}")
+            buffer.record_step(msg_id, 'join', code, join_resp, time.monotonic() - started, True, group_chat_id)
+            buffer.update(msg_id, join_succeeded=True)
+            buffer.update_link(link_id, chat_id=group_chat_id, name=join_resp["response"].get('name'),
+                               wa_session=wa_session.name, joined_at=datetime.now(),
+                               **link_join_fields(failure_count, code, True))
+            if group_chat_id.endswith('@g.us'):
+                await loop.run_in_executor(None, remember_membership, wa_session.name, link_id, group_chat_id)
+        else:
+            logger.info("joining group DID NOT SUCCEED")
+            buffer.record_step(msg_id, 'join', code, join_resp, time.monotonic() - started, False)
+            buffer.update_link(link_id, **link_join_fields(failure_count, code, False))
+            buffer.update(msg_id, join_succeeded=False)
+            return
+
+    if group_chat_id.endswith('@g.us'):
+        await limiters['send'].acquire_async()
+        started = time.monotonic()
+        try:
+            send_code, send_resp = await client.send_text(chat_id=group_chat_id, message=message)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            # the join above stands, only the send failed
+            buffer.record_failed_call(msg_id, 'send', e, time.monotonic() - started, group_chat_id)
+            return
+        sent = bool(send_code == 200 and send_resp['success'])
+        buffer.record_step(msg_id, 'send', send_code, send_resp, time.monotonic() - started, sent, group_chat_id)
+        buffer.update(msg_id, message_send_succeeded=sent)
+        if sent:
+            logger.info("successfully sent message to group")
+        else:
+            await loop.run_in_executor(None, forget_membership, wa_session.name, link_id)
+            logger.info(f"message sending DID NOT SUCCEED: {response_error(send_resp)}")
+    else:
+        logger.info("malformed link")
+
+
+def call_in_app_context(app: Flask, fn, *args):
+    # runs on the async engine's db thread, which has no app context of its own
+    with app.app_context():
+        return fn(*args)
+
+
+# ------------------------- invite pre-check -------------------------
+# with PREFLIGHT_INVITE_CHECK the campaign job asks the api about every link it has no working membership for before
+# any message row is created. invites the api calls invalid count as a failed join (backoff, quarantine) and are left
+# out, so the campaign's join budget only goes to live groups.
+
+def check_invite_links(links_list: List[GroupLink], campaign_id=None) -> List[GroupLink]:
+    dead = asyncio.run(find_dead_invite_links(links_list))
+    save_dead_invite_links(dead, campaign_id)
+    return [link for link in links_list if link.id not in dead]
+
+
+async def find_dead_invite_links(links_list: List[GroupLink]) -> dict:
+    # {link id: GroupLink failure fields} of the dead invites, api calls only. the async engine awaits this from its
+    # own loop and writes the result from its db thread
+    unproven = [link for link in links_list if link.chat_id is None or link.failure_count]
+    if not unproven:
+        return {}
+    results = await check_invites_async(unproven)
+    dead = {}
+    for link in unproven:
+        code, valid = results[link.id]
+        fields = link_join_fields(link.failure_count, code, valid)
+        if fields and not valid:
+            dead[link.id] = {'id': link.id, **fields}
+    logger.info(f" checked {len(unproven)} invite links, {len(dead)} dead")
+    return dead
+
+
+def save_dead_invite_links(dead: dict, campaign_id=None):
+    if dead:
+        db.session.bulk_update_mappings(GroupLink, list(dead.values()))
+        db.session.commit()
+        if campaign_id is not None:
+            # they were part of the progress total
+            count_progress(campaign_id, failed=len(dead))
+
+
+async def check_invites_async(links: List[GroupLink]) -> dict:
+    # {link id: (status code, valid)}. every session checks its own links, paced by its check budget
+    results = {}
+
+    async def check(wa_session: WaSession, client: AsyncWhatsapp, semaphore: asyncio.Semaphore, link_id: int,
+                    link_url: str):
+        async with semaphore:
+            await wa_session.limiters['check'].acquire_async()
+            try:
+                code, resp = await client.group_info(link_url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                code, resp = None, None
+            valid = code == 200 and isinstance(resp, dict) and resp.get('success') and isinstance(
+                resp.get('response'), dict)
+            results[link_id] = (code, bool(valid))
+
+    async with AsyncWhatsapp.create_session() as session:
+        checks = []
+        for name, shard in partition_links(links).items():
+            wa_session = get_session(name)
+            client = AsyncWhatsapp(wa_session.url, session, wa_session.health)
+            semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+            checks.extend(check(wa_session, client, semaphore, link.id, link.link) for link in shard)
+        await asyncio.gather(*checks)
+    return results
+
+
+# ------------------------- run locks -------------------------
+# every campaign shard (one per session) is run by at most one job at a time. the lock is taken when the campaign job
+# starts, renewed by the shard job while it runs and by every group job of a fan-out chain, and dropped when the shard
+# is finished. a paused shard keeps it until its rescheduled job runs. a lock whose worker was killed expires after
+# CAMPAIGN_LOCK_TTL seconds, so resume_stalled_campaigns can pick the campaign up again.
+
+class RunLock:
+    def __init__(self, campaign_id, session: str):
+        self.key = campaign_key(campaign_id, f'{session}:lock')
+
+    def claim(self, run: str) -> bool:
+        # free, or already held by this run (a shard job queued by the campaign job, a paused shard coming back)
+        if rq.connection.set(self.key, run, nx=True, ex=CAMPAIGN_LOCK_TTL):
+            return True
+        return run is not None and rq.connection.get(self.key) == run.encode() and self.refresh()
+
+    def refresh(self, ttl: float = CAMPAIGN_LOCK_TTL) -> bool:
+        return bool(rq.connection.expire(self.key, math.ceil(ttl)))
+
+    def held(self) -> bool:
+        return bool(rq.connection.exists(self.key))
+
+    def release(self):
+        rq.connection.delete(self.key)
+
+    @contextmanager
+    def heartbeat(self):
+        # renews the lock from a background thread while a long shard job runs
+        stopped = threading.Event()
+
+        def renew():
+            while not stopped.wait(CAMPAIGN_LOCK_TTL / 3):
+                try:
+                    self.refresh()
+                except RedisError:
+                    logger.warning(" could not renew the campaign lock", exc_info=True)
+
+        thread = threading.Thread(target=renew, name='campaign-lock', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+
+
+def claim_run_locks(campaign_id, sessions: List[str], run: str) -> bool:
+    # all of the campaign's shard locks or none of them
+    claimed = []
+    for session in sessions:
+        lock = RunLock(campaign_id, session)
+        if not lock.claim(run):
+            for other in claimed:
+                other.release()
+            return False
+        claimed.append(lock)
+    return True
+
+
+def campaign_running(campaign_id) -> bool:
+    # a shard holds its lock, or a campaign job for it is being worked on by a live worker
+    if any(RunLock(campaign_id, wa_session.name).held() for wa_session in wa_sessions):
+        return True
+    registry = rq.get_queue('campaign').started_job_registry
+    for job in Job.fetch_many(registry.get_job_ids(), connection=rq.connection):
+        if job is not None and job.args and job.args[0] == campaign_id and job.worker_name and \
+                rq.connection.exists(Worker.redis_worker_namespace_prefix + job.worker_name):
+            return True
+    return False
+
+
+# ------------------------- fan-out engine -------------------------
+# the campaign job only seeds a redis list with the link/message ids and starts CAMPAIGN_CONCURRENCY group jobs. every
+# group job pulls the next pending pair when it finishes, so at most CAMPAIGN_CONCURRENCY groups per session are in
+# flight at any time and the work spreads over however many worker replicas are running.
+
+def campaign_key(campaign_id, name: str):
+    return f'campaign:{campaign_id}:{name}'
+
+
+def shard_keys(campaign_id, session: str) -> List[str]:
+    # the fan-out bookkeeping of one session shard. removed when the shard finishes, a crashed run's keys expire after
+    # CAMPAIGN_PROGRESS_TTL
+    return [campaign_key(campaign_id, f'{session}:{name}') for name in ('pending', 'done', 'total')]
+
+
+def finish_shard(campaign_id, session: str):
+    # a campaign split over several sessions is finished when its last shard is
+    RunLock(campaign_id, session).release()
+    rq.connection.delete(*shard_keys(campaign_id, session))
+    if rq.connection.decr(campaign_key(campaign_id, 'shards')) <= 0:
+        rq.connection.delete(campaign_key(campaign_id, 'shards'))
+        mark_campaign_finished(campaign_id)
+        logger.info(" DONE PROCESSING ALL LINKS IN THIS CAMPAIGN")
+
+
+def mark_campaign_started(campaign_id):
+    campaign = db.session.get(Campaign, campaign_id)
+    if campaign:
+        campaign.started_at = datetime.now()
+        campaign.finished_at = None
+        db.session.commit()
+
+
+def mark_campaign_finished(campaign_id):
+    campaign = db.session.get(Campaign, campaign_id)
+    if campaign:
+        campaign.finished_at = datetime.now()
+        db.session.commit()
+    finish_progress(campaign_id)
+
+
+def fan_out_campaign(pairs, campaign_id, session: str):
+    # pairs are (link id, message id), any iterable. each session shard has its own pending list, it is filled
+    # completely before the first group job starts so the done == total check stays right
+    redis = rq.connection
+    pending_key, _, total_key = shard_keys(campaign_id, session)
+    redis.delete(*shard_keys(campaign_id, session))
+    total = 0
+    for chunk in chunked_iter(pairs, CAMPAIGN_CHUNK_SIZE):
+        redis.rpush(pending_key, *(f'{link_id}:{msg_id}' for link_id, msg_id in chunk))
+        total += len(chunk)
+    redis.expire(pending_key, CAMPAIGN_PROGRESS_TTL)
+    redis.set(total_key, total, ex=CAMPAIGN_PROGRESS_TTL)
+
+    if not total:
+        finish_shard(campaign_id, session)
+        return
+
+    for _ in range(min(CAMPAIGN_CONCURRENCY, total)):
+        queue_next_group(campaign_id, session)
+    logger.info(f" fanned out {total} links on {session}, concurrency {CAMPAIGN_CONCURRENCY}")
+
+
+def pause_shard(campaign_id, id_ranges: List[tuple], engine: str, session: str, delay: float, run: str):
+    # the session's circuit breaker stopped the shard. it is queued again for when the breaker closes and, like any
+    # resumed run, skips the groups that got the message. it keeps its lock until then
+    rq.connection.hset(progress_key(campaign_id), f'paused_until:{session}', time.time() + delay)
+    RunLock(campaign_id, session).refresh(delay + CAMPAIGN_LOCK_TTL)
+    campaign_task.schedule(timedelta(seconds=delay), campaign_id, id_ranges, engine, session=session, run=run,
+                           timeout=CAMPAIGN_TIMEOUT)
+    logger.warning(f" paused on {session} for {delay:.0f}s, the api is unhealthy")
+
+
+def queue_next_group(campaign_id, session: str):
+    pair = rq.connection.lpop(campaign_key(campaign_id, f'{session}:pending'))
+    if pair is None:
+        return False
+    link_id, msg_id = map(int, pair.split(b':'))
+    group_task.queue(campaign_id, link_id, msg_id, session=session)
+    return True
+
+
+@rq.job('join', timeout=STEP_JOB_TIMEOUT)
+def group_task(campaign_id, link_id: int, msg_id: int, session: str = None, reserved: str = None, **kwargs):
+    with log_context(campaign=campaign_id, session=session, link=link_id):
+        wa_session = get_session(session)
+        session = wa_session.name
+        lock = RunLock(campaign_id, session)
+        paused = wa_session.health.open_for()
+        if paused:
+            # the group's slot in the chain waits for the circuit breaker instead of failing
+            lock.refresh(paused + CAMPAIGN_LOCK_TTL)
+            group_task.schedule(timedelta(seconds=paused), campaign_id, link_id, msg_id, session=session,
+                                reserved=reserved)
+            return
+        # the chain is the running shard, every group job renews its lock
+        lock.refresh()
+        deferred = None
+        try:
+            link = db.session.get(GroupLink, link_id)
+            msg = db.session.get(Message, msg_id)
+            # a retried job must not send twice
+            if link is not None and link.active and not msg.message_send_succeeded:
+                message = db.session.get(Campaign, campaign_id).message
+                buffer = MessageBuffer(campaign_id, autoflush=False)
+                try:
+                    deferred = process_group_link(wa_session, link, msg_id, message, buffer, RATE_MAX_WAIT, reserved)
+                finally:
+                    buffer.flush()
+        finally:
+            if deferred:
+                # the group keeps its slot in the chain and comes back when its rate token is due
+                step, wait = deferred
+                lock.refresh(wait + CAMPAIGN_LOCK_TTL)
+                group_task.schedule(timedelta(seconds=wait), campaign_id, link_id, msg_id, session=session,
+                                    reserved=step)
+            else:
+                # keep the chain going even when this group failed
+                _, done_key, total_key = shard_keys(campaign_id, session)
+                pipe = rq.connection.pipeline()
+                pipe.incr(done_key)
+                pipe.expire(done_key, CAMPAIGN_PROGRESS_TTL)
+                pipe.get(total_key)
+                done, _, total = pipe.execute()
+                queue_next_group(campaign_id, session)
+                if done == int(total or 0):
+                    finish_shard(campaign_id, session)
+
+
+# ------------------------- leave sweeper -------------------------
+# campaigns never wait on leaving. every group records when the bot last joined or used it (GroupLink.joined_at) and
+# this job, run every minute by the scheduler, leaves the ones idle for LEAVE_AFTER seconds through the session that
+# joined them, paced by that session's leave budget. it stops early whenever sends or joins are waiting, skips sessions
+# whose circuit breaker is open, and keeps groups a running campaign joined and has not sent to yet, however long the
+# send is deferred.
+
+LEAVE_SWEEP_LOCK = 'leave-sweeper'
+LEAVE_SWEEP_TIMEOUT = 60 * 60
+# answers to leaveGroup that mean the bot is not in the group (anymore)
+NOT_IN_GROUP_ERRORS = ('not a participant', 'not in group', 'not a member')
+
+
+@rq.job('leave')
+def sweep_leaves(**kwargs):
+    if not EXIT_GROUPS:
+        return
+    # a long sweep must not overlap with the next scheduled one
+    if not rq.connection.set(LEAVE_SWEEP_LOCK, os.getpid(), nx=True, ex=LEAVE_SWEEP_TIMEOUT):
+        return
+    left = 0
+    try:
+        cutoff = datetime.now() - timedelta(seconds=LEAVE_AFTER)
+        query = db.select(GroupLink).where(GroupLink.joined_at <= cutoff, GroupLink.chat_id.isnot(None))
+        running = [int(campaign_id) for campaign_id in rq.connection.smembers(ACTIVE_CAMPAIGNS_KEY)]
+        if running:
+            query = query.where(GroupLink.id.notin_(db.select(Message.group_link).where(
+                Message.campaign_id.in_(running), Message.join_succeeded.is_(True),
+                Message.message_send_succeeded.is_(None))))
+        paused = {session.name for session in wa_sessions if session.health.open_for()}
+        if paused:
+            logger.info(f" circuit breaker open for {', '.join(sorted(paused))}, not leaving their groups")
+        due = db.session.execute(query.order_by(GroupLink.joined_at).limit(LEAVE_BATCH_SIZE)).scalars().all()
+        for link in due:
+            if any(rq.get_queue(name).count for name in ('send', 'join')):
+                logger.info(" sends or joins are waiting, stopping the leave sweep early")
+                break
+            if get_session(link.wa_session).name in paused:
+                continue
+            with log_context(link=link.id):
+                left += leave_link(link)
+    finally:
+        rq.connection.delete(LEAVE_SWEEP_LOCK)
+    if left:
+        logger.info(f" left {left} groups")
+
+
+def left_group(code, resp) -> bool:
+    # a 2xx, or an answer saying the bot is not a participant. 429s, auth errors and server errors are tried again
+    if code is None:
+        return False
+    if 200 <= code < 300:
+        return not isinstance(resp, dict) or resp.get('success') is not False or not_in_group(resp)
+    return code < 500 and code != 429 and not_in_group(resp)
+
+
+def not_in_group(resp) -> bool:
+    text = json.dumps(resp).lower()
+    return any(error in text for error in NOT_IN_GROUP_ERRORS)
+
+
+def leave_link(link: GroupLink) -> bool:
+    # idempotent: a group the bot is no longer in counts as left. any other failure is tried again after another
+    # LEAVE_AFTER
+    session = get_session(link.wa_session)
+    session.limiters['leave'].acquire()
+    try:
+        exit_code, exit_resp = session.client.leave_group(chat_id=link.chat_id)
+    except requests.RequestException:
+        logger.exception(f" could not leave {link.chat_id}")
+        exit_code, exit_resp = None, None
+    left = left_group(exit_code, exit_resp)
+    link.joined_at = None if left else datetime.now()
+    db.session.commit()
+    if left:
+        forget_membership(session.name, link.id)
+        logger.info(f"[LEFT GROUP] {link.chat_id}")
+    elif exit_code is not None:
+        logger.warning(f" could not leave {link.chat_id} ({exit_code}), trying again in {LEAVE_AFTER}s")
+    return left
+
+
+def queue_campaign(campaign: Campaign) -> bool:
+    # only the campaign id goes on the queue, the worker reads the links itself. a campaign that has run before
+    # resumes: its groups that already got the message are skipped. false when the campaign is still running
+    if campaign_running(campaign.id):
+        return False
+    campaign_task.queue(campaign.id, timeout=CAMPAIGN_TIMEOUT)
+    # campaign_task(campaign.id)
+
+    campaign.has_run = True
+    db.session.add(campaign)
+    db.session.commit()
+    return True
+
+
+@rq.job('default')
+def resume_stalled_campaigns(**kwargs):
+    # campaigns that started but never finished and that nothing is working on, e.g. their worker was killed by a
+    # redeploy. runs when the scheduler starts and every few minutes after that
+    campaign_list = db.session.execute(db.select(Campaign).where(
+        Campaign.active.is_(True), Campaign.started_at.isnot(None), Campaign.finished_at.is_(None))).scalars().all()
+    for campaign in campaign_list:
+        if queue_campaign(campaign):
+            logger.info(f"RESUMING CAMPAIGN :: {campaign.id} {campaign.title}")
+
+
+@click.command('resume-campaigns')
+@with_appcontext
+def resume_campaigns():
+    """Re-queue campaigns that started but never finished and are not running any more."""
+    ensure_schema()
+    resume_stalled_campaigns()
+
+
+@click.command('schedule-jobs')
+@with_appcontext
+def schedule_jobs():
+    """Register the periodic jobs with rq-scheduler, re-running it replaces them."""
+    purge_step_payloads.cron('30 3 * * *', 'purge-step-payloads')
+    sweep_leaves.cron('* * * * *', 'sweep-leaves', timeout=LEAVE_SWEEP_TIMEOUT)
+    resume_stalled_campaigns.cron('*/5 * * * *', 'resume-stalled-campaigns')
+    logger.info(" scheduled purge-step-payloads, sweep-leaves and resume-stalled-campaigns")
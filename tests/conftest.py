@@ -0,0 +1,57 @@
+"""
+the tests run on a throwaway sqlite file and, where redis is needed, on fakeredis (pip install pytest fakeredis lupa,
+lupa runs the lua scripts). core.py reads its settings at import, so they are set here before anything imports it.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='wa-tests-')
+
+os.environ.update({
+    'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(WORKDIR, "tests.db")}',
+    'RQ_REDIS_URL': 'redis://localhost:6379/15',
+    'LOG_LEVEL': 'WARNING',
+})
+os.environ.pop('WA_SESSIONS', None)
+sys.path.insert(0, REPO_ROOT)
+
+import core  # noqa: E402
+from worker import app as worker_app  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def web_app():
+    # app.py reads users.yaml from the working directory at import
+    shutil.copy(os.path.join(REPO_ROOT, 'users.yaml.example'), os.path.join(WORKDIR, 'users.yaml'))
+    cwd = os.getcwd()
+    os.chdir(WORKDIR)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+    return app
+
+
+@pytest.fixture
+def db():
+    with worker_app.app_context():
+        core.db.drop_all()
+        core.db.create_all()
+        yield core.db
+        core.db.session.remove()
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    connection = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(core.rq, '_connection', connection)
+    # registered scripts belong to the connection they were registered on
+    monkeypatch.setattr(core.RateLimiter, '_script', None)
+    monkeypatch.setattr(core.SessionHealth, '_script', None)
+    return connection
@@ -0,0 +1,21 @@
+import core
+
+
+def add_links(db, count, name='Test', **fields):
+    fields.setdefault('active', True)
+    links = [core.GroupLink(link=f'https://chat.whatsapp.com/{name}{i:04d}', **fields)
+             for i in range(count)]
+    db.session.add_all(links)
+    db.session.commit()
+    return [link.id for link in links]
+
+
+def add_campaign(db):
+    campaign = core.Campaign(title='test', message='hello')
+    db.session.add(campaign)
+    db.session.commit()
+    return campaign.id
+
+
+def pending_ids(campaign_id, id_ranges, wa_session):
+    return [[link.id for link in chunk] for chunk in core.pending_link_chunks(campaign_id, id_ranges, wa_session)]
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import core
+
+
+class FakeApi(BaseHTTPRequestHandler):
+    # answers every call with the status queued for its endpoint, 200 once they run out
+    statuses = {}
+    calls = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.calls.append(self.path)
+        queued = self.statuses.get(self.path)
+        status = queued.pop(0) if queued else 200
+        body = json.dumps({'success': status == 200, 'response': True}).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def api(server, monkeypatch):
+    monkeypatch.setattr(core, 'WA_BACKOFF_FACTOR', 0)
+    monkeypatch.setattr(core, 'record_api_call', lambda *args: None)
+    monkeypatch.setattr(core.Whatsapp, '_sessions_pid', None)
+    monkeypatch.setattr(FakeApi, 'statuses', {})
+    monkeypatch.setattr(FakeApi, 'calls', [])
+    return FakeApi, server
+
+
+async def call_async(url, endpoint):
+    async with core.AsyncWhatsapp.create_session() as session:
+        client = core.AsyncWhatsapp(url, session)
+        return await client.send_request(endpoint, {'args': {}})
+
+
+def call_sync(url, endpoint):
+    return core.Whatsapp(url).send_request(endpoint, {'args': {}})
+
+
+def call(flavour, url, endpoint):
+    return asyncio.run(call_async(url, endpoint)) if flavour == 'async' else call_sync(url, endpoint)
+
+
+@pytest.mark.parametrize('flavour', ['sync', 'async'])
+@pytest.mark.parametrize('status', [500, 502, 504])
+def test_send_is_not_retried_after_a_gateway_error(api, flavour, status):
+    fake, url = api
+    fake.statuses['/sendText'] = [status]
+    assert call(flavour, url, '/sendText')[0] == status
+    assert fake.calls == ['/sendText']
+
+
+@pytest.mark.parametrize('flavour', ['sync', 'async'])
+def test_send_is_retried_when_unavailable(api, flavour):
+    fake, url = api
+    fake.statuses['/sendText'] = [503]
+    assert call(flavour, url, '/sendText')[0] == 200
+    assert fake.calls == ['/sendText'] * 2
+
+
+@pytest.mark.parametrize('flavour', ['sync', 'async'])
+def test_other_calls_are_retried_on_server_errors(api, flavour):
+    fake, url = api
+    fake.statuses['/joinGroupViaLink'] = [502, 504]
+    assert call(flavour, url, '/joinGroupViaLink')[0] == 200
+    assert fake.calls == ['/joinGroupViaLink'] * 3
@@ -0,0 +1,83 @@
+from collections import deque
+
+import pytest
+
+import core
+from helpers import add_campaign, add_links
+
+
+class FakeQueue:
+    # group jobs queued or scheduled by the chain, run one at a time in order
+    def __init__(self):
+        self.jobs = deque()
+        self.processed = []
+        self.defer = {}
+
+    def queue(self, *args, **kwargs):
+        self.jobs.append((args, kwargs))
+
+    def schedule(self, delay, *args, **kwargs):
+        self.jobs.append((args, kwargs))
+
+    def process_group_link(self, session, link, msg_id, message, buffer, max_wait=None, reserved=None):
+        self.processed.append(link.id)
+        return self.defer.pop(link.id, None)
+
+    def drain(self):
+        while self.jobs:
+            args, kwargs = self.jobs.popleft()
+            core.group_task(*args, **kwargs)
+
+
+@pytest.fixture
+def chain(db, redis, monkeypatch):
+    fake = FakeQueue()
+    monkeypatch.setattr(core.group_task, 'queue', fake.queue)
+    monkeypatch.setattr(core.group_task, 'schedule', fake.schedule)
+    monkeypatch.setattr(core, 'process_group_link', fake.process_group_link)
+    monkeypatch.setattr(core, 'CAMPAIGN_CONCURRENCY', 3)
+    return fake
+
+
+def fan_out(db, link_ids):
+    campaign_id = add_campaign(db)
+    messages = [core.Message(campaign_id=campaign_id, group_link=link_id) for link_id in link_ids]
+    db.session.add_all(messages)
+    db.session.commit()
+    core.start_progress(campaign_id, len(link_ids))
+    core.fan_out_campaign([(m.group_link, m.id) for m in messages], campaign_id, core.wa_sessions[0].name)
+    return campaign_id
+
+
+def test_campaign_finishes_after_its_last_group(db, redis, chain):
+    link_ids = add_links(db, 7)
+    campaign_id = fan_out(db, link_ids)
+    assert len(chain.jobs) == core.CAMPAIGN_CONCURRENCY
+    chain.drain()
+    assert sorted(chain.processed) == link_ids
+    assert db.session.get(core.Campaign, campaign_id).finished_at is not None
+    assert not redis.sismember(core.ACTIVE_CAMPAIGNS_KEY, campaign_id)
+
+
+def test_deferred_groups_are_counted_once(db, redis, chain):
+    link_ids = add_links(db, 4)
+    chain.defer = {link_ids[0]: ('join', 5), link_ids[1]: ('send', 5)}
+    campaign_id = fan_out(db, link_ids)
+    chain.drain()
+    assert sorted(chain.processed) == sorted(link_ids + link_ids[:2])
+    assert db.session.get(core.Campaign, campaign_id).finished_at is not None
+
+
+def test_finished_shard_leaves_no_keys_behind(db, redis, chain):
+    campaign_id = fan_out(db, add_links(db, 3))
+    session = core.wa_sessions[0].name
+    assert redis.ttl(core.campaign_key(campaign_id, f'{session}:total')) > 0
+    chain.drain()
+    assert not redis.exists(*core.shard_keys(campaign_id, session))
+    assert redis.keys(f'campaign:{campaign_id}:*') == [core.progress_key(campaign_id).encode()]
+
+
+def test_empty_shard_finishes_right_away(db, redis, chain):
+    campaign_id = fan_out(db, [])
+    assert not chain.jobs
+    assert db.session.get(core.Campaign, campaign_id).finished_at is not None
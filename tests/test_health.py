@@ -0,0 +1,88 @@
+import pytest
+
+import core
+
+# seconds between calls when a session joins and sends at the default budgets
+DEFAULT_PACE = 60 / (core.RATE_JOINS_PER_MINUTE + core.RATE_SENDS_PER_MINUTE)
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch, redis):
+    pytest.importorskip('lupa')
+    clock = FakeClock()
+    monkeypatch.setattr(core.time, 'time', clock.time)
+    monkeypatch.setattr(core.time, 'monotonic', clock.time)
+    return clock
+
+
+@pytest.fixture
+def health(clock):
+    return core.SessionHealth('test')
+
+
+def drive(health, clock, statuses, pace=DEFAULT_PACE, duration=1):
+    for status in statuses:
+        health.observe(status, duration)
+        clock.now += pace
+
+
+def test_throttling_at_the_default_pace_trips_the_breaker(health, clock):
+    drive(health, clock, [429] * (core.BREAKER_MIN_CALLS - 1))
+    assert health.open_for() == 0
+    drive(health, clock, [429])
+    assert health.open_for() > 0
+    assert health.scale() == core.ADAPTIVE_MIN_SCALE
+
+
+def test_mixed_failures_at_the_default_pace_trip_the_breaker(health, clock):
+    drive(health, clock, [200, 429, 503, None] * core.BREAKER_MIN_CALLS)
+    assert health.open_for() > 0
+
+
+def test_occasional_failures_leave_the_breaker_closed(health, clock):
+    drive(health, clock, ([200] * 3 + [429]) * core.BREAKER_MIN_CALLS)
+    assert health.open_for() == 0
+
+
+def test_failures_spread_past_the_window_leave_the_breaker_closed(health, clock):
+    drive(health, clock, [429] * 3 * core.BREAKER_MIN_CALLS, pace=core.BREAKER_WINDOW / (core.BREAKER_MIN_CALLS - 1.5))
+    assert health.open_for() == 0
+
+
+def test_congestion_cuts_the_scale_once_per_window(health, clock):
+    drive(health, clock, [429, 429], pace=0)
+    assert health.scale() == core.ADAPTIVE_DECREASE
+    clock.now += core.ADAPTIVE_WINDOW
+    drive(health, clock, [200], duration=core.ADAPTIVE_LATENCY_TARGET + 1)
+    assert health.scale() == core.ADAPTIVE_DECREASE ** 2
+
+
+def test_successes_add_the_scale_back_up_to_one(health, clock):
+    drive(health, clock, [503])
+    drive(health, clock, [200] * 4)
+    assert health.scale() == pytest.approx(core.ADAPTIVE_DECREASE + 4 * core.ADAPTIVE_INCREASE)
+    drive(health, clock, [200] * 100)
+    assert health.scale() == 1
+
+
+class NoRedis:
+    def __getattr__(self, name):
+        raise AssertionError(f'redis called from the event loop: {name}')
+
+
+def test_event_loop_reads_only_the_cached_health(health, clock, monkeypatch):
+    drive(health, clock, [429] * core.BREAKER_MIN_CALLS)
+    health.refresh()
+    limit = core.AdaptiveLimit(20, health)
+    clock.now += 60
+    monkeypatch.setattr(core.rq, '_connection', NoRedis())
+    assert limit.size() == int(20 * core.ADAPTIVE_MIN_SCALE)
+    assert health.open_for(refresh=False) > 0
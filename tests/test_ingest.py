@@ -0,0 +1,52 @@
+from datetime import datetime
+
+import core
+from helpers import add_links
+
+LINK = 'https://chat.whatsapp.com/Test{:04d}'
+
+
+def ingest(web_app, links):
+    with web_app.app.app_context():
+        return web_app.ingest_links(iter(links))
+
+
+def saved(db):
+    db.session.expire_all()
+    return {link.link: link for link in db.session.execute(db.select(core.GroupLink)).scalars()}
+
+
+def test_new_links_are_counted_and_saved(db, web_app):
+    links = [LINK.format(i) for i in range(3)]
+    assert ingest(web_app, links) == {'new': 3, 'reactivated': 0, 'duplicates': 0}
+    assert sorted(saved(db)) == links
+    assert all(link.active for link in saved(db).values())
+
+
+def test_repeats_in_the_input_are_duplicates(db, web_app):
+    assert ingest(web_app, [LINK.format(0), LINK.format(1), LINK.format(0)]) == {
+        'new': 2, 'reactivated': 0, 'duplicates': 1}
+
+
+def test_active_links_are_duplicates(db, web_app):
+    add_links(db, 2)
+    assert ingest(web_app, [LINK.format(i) for i in range(3)]) == {'new': 1, 'reactivated': 0, 'duplicates': 2}
+
+
+def test_inactive_and_quarantined_links_are_reactivated(db, web_app):
+    inactive = add_links(db, 1, active=False)
+    quarantined = add_links(db, 1, name='Quarantined', failure_count=5, quarantined_at=datetime.now())
+    links = [db.session.get(core.GroupLink, link_id).link for link_id in inactive + quarantined]
+    assert ingest(web_app, links) == {'new': 0, 'reactivated': 2, 'duplicates': 0}
+    for link in saved(db).values():
+        assert link.active
+        assert link.quarantined_at is None
+        assert not link.failure_count
+
+
+def test_counts_add_up_over_chunks(db, web_app, monkeypatch):
+    monkeypatch.setattr(web_app, 'LINK_INGEST_CHUNK_SIZE', 2)
+    add_links(db, 2, active=False)
+    links = [LINK.format(i) for i in range(5)]
+    assert ingest(web_app, links + links[:1]) == {'new': 3, 'reactivated': 2, 'duplicates': 1}
+    assert len(saved(db)) == 5
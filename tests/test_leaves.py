@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import core
+from helpers import add_campaign, add_links
+
+LEFT = (200, {'success': True, 'response': True})
+
+
+@pytest.mark.parametrize('code, resp', [
+    LEFT,
+    (200, {'success': False, 'error': 'Not a participant'}),
+    (400, {'success': False, 'error': 'Not a participant of this group'}),
+])
+def test_left_group(code, resp):
+    assert core.left_group(code, resp)
+
+
+@pytest.mark.parametrize('code, resp', [
+    (None, None),
+    (200, {'success': False, 'error': 'session not ready'}),
+    (401, {'success': False, 'error': 'unauthorized'}),
+    (403, {'success': False, 'error': 'forbidden'}),
+    (429, {'success': False, 'error': 'not a participant'}),
+    (502, {'success': False, 'response': None, 'error': '502 response is not json: <html>'}),
+])
+def test_not_left_group(code, resp):
+    assert not core.left_group(code, resp)
+
+
+class FakeApi:
+    def __init__(self):
+        self.answer = LEFT
+        self.calls = []
+
+    def leave_group(self, chat_id):
+        self.calls.append(chat_id)
+        return self.answer
+
+
+@pytest.fixture
+def sweeper(db, redis, monkeypatch):
+    pytest.importorskip('lupa')
+    monkeypatch.setattr(core, 'EXIT_GROUPS', True)
+    monkeypatch.setattr(core.time, 'sleep', lambda seconds: None)
+    session = core.wa_sessions[0]
+    # read the breaker from redis on every call
+    monkeypatch.setattr(session.health, 'cache_for', -1)
+    api = FakeApi()
+    monkeypatch.setattr(session.client, 'leave_group', api.leave_group)
+    return api
+
+
+def joined(db, count, seconds_ago, name='Test'):
+    link_ids = add_links(db, count, name=name, wa_session=core.wa_sessions[0].name,
+                         joined_at=datetime.now() - timedelta(seconds=seconds_ago))
+    for link_id in link_ids:
+        db.session.get(core.GroupLink, link_id).chat_id = f'{link_id}@g.us'
+    db.session.commit()
+    return link_ids
+
+
+def joined_at(db, link_ids):
+    db.session.expire_all()
+    return [db.session.get(core.GroupLink, link_id).joined_at for link_id in link_ids]
+
+
+def test_idle_groups_are_left(db, sweeper):
+    idle = joined(db, 2, core.LEAVE_AFTER + 60)
+    recent = joined(db, 1, 60, name='Recent')
+    core.sweep_leaves()
+    assert sweeper.calls == [f'{link_id}@g.us' for link_id in idle]
+    assert joined_at(db, idle) == [None, None]
+    assert joined_at(db, recent)[0] is not None
+
+
+def test_failed_leave_is_tried_again_later(db, sweeper):
+    link_ids = joined(db, 1, core.LEAVE_AFTER + 60)
+    sweeper.answer = (429, {'success': False, 'error': 'rate limited'})
+    core.sweep_leaves()
+    assert joined_at(db, link_ids)[0] > datetime.now() - timedelta(seconds=60)
+
+
+def test_groups_waiting_for_a_send_are_kept(db, redis, sweeper):
+    waiting, sent = joined(db, 1, core.LEAVE_AFTER + 60), joined(db, 1, core.LEAVE_AFTER + 60, name='Sent')
+    campaign_id = add_campaign(db)
+    db.session.add_all([core.Message(campaign_id=campaign_id, group_link=waiting[0], join_succeeded=True),
+                        core.Message(campaign_id=campaign_id, group_link=sent[0], join_succeeded=True,
+                                     message_send_succeeded=True)])
+    db.session.commit()
+    redis.sadd(core.ACTIVE_CAMPAIGNS_KEY, campaign_id)
+    core.sweep_leaves()
+    assert sweeper.calls == [f'{sent[0]}@g.us']
+    # once the campaign is over the group is left like any other
+    redis.srem(core.ACTIVE_CAMPAIGNS_KEY, campaign_id)
+    core.sweep_leaves()
+    assert sweeper.calls == [f'{sent[0]}@g.us', f'{waiting[0]}@g.us']
+
+
+def test_sessions_with_an_open_breaker_are_skipped(db, redis, sweeper):
+    link_ids = joined(db, 1, core.LEAVE_AFTER + 60)
+    redis.set(core.wa_sessions[0].health.breaker_key, 1, ex=60)
+    core.sweep_leaves()
+    assert sweeper.calls == []
+    assert joined_at(db, link_ids)[0] is not None
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import core
+
+
+def test_join_resets_failures():
+    assert core.link_join_fields(3, 200, True) == {'failure_count': 0, 'next_attempt_at': None}
+
+
+def test_join_without_failures_changes_nothing():
+    assert core.link_join_fields(None, 200, True) == {}
+    assert core.link_join_fields(0, 200, True) == {}
+
+
+@pytest.mark.parametrize('code', [None, 429, 500, 502])
+def test_failures_that_say_nothing_about_the_link_are_not_counted(code):
+    assert core.link_join_fields(2, code, False) == {}
+
+
+def test_failed_join_backs_off_exponentially():
+    before = datetime.now()
+    first = core.link_join_fields(None, 404, False)
+    third = core.link_join_fields(2, 404, False)
+    assert first['failure_count'] == 1
+    assert third['failure_count'] == 3
+    assert first['next_attempt_at'] - before >= timedelta(seconds=core.LINK_RETRY_BACKOFF)
+    assert third['next_attempt_at'] - before >= timedelta(seconds=core.LINK_RETRY_BACKOFF * 4)
+    assert 'quarantined_at' not in first
+
+
+def test_backoff_is_capped(monkeypatch):
+    monkeypatch.setattr(core, 'LINK_MAX_FAILURES', 100)
+    fields = core.link_join_fields(40, 404, False)
+    assert fields['next_attempt_at'] - datetime.now() <= timedelta(seconds=core.LINK_RETRY_BACKOFF_MAX)
+
+
+def test_link_is_quarantined_after_max_failures():
+    fields = core.link_join_fields(core.LINK_MAX_FAILURES - 1, 404, False)
+    assert fields['failure_count'] == core.LINK_MAX_FAILURES
+    assert fields['quarantined_at'] is not None
@@ -0,0 +1,33 @@
+import core
+
+
+def series(text, prefix):
+    return [line for line in text.splitlines() if line.startswith(prefix)]
+
+
+def test_histograms_have_every_bucket_in_order(web_app, redis):
+    core.record_api_call('/sendText', 200, 0.5, {'success': True})
+    core.record_api_call('/sendText', 200, 45, {'success': True})
+    text = web_app.render_metrics()
+    lines = series(text, 'wa_request_duration_seconds')
+    bounds = [str(bound) for bound in core.LATENCY_BUCKETS] + ['+Inf']
+    assert [line.split('le="')[1].split('"')[0] for line in lines[:-2]] == bounds
+    assert [int(line.rsplit(' ', 1)[1]) for line in lines[:-2]] == [0, 0, 1, 1, 1, 1, 1, 1, 2, 2]
+    assert lines[-2] == 'wa_request_duration_seconds_sum{endpoint="/sendText"} 45.5'
+    assert lines[-1] == 'wa_request_duration_seconds_count{endpoint="/sendText"} 2'
+
+
+def test_every_series_gets_its_own_buckets(web_app, redis):
+    core.record_api_call('/sendText', 200, 0.3, {'success': True})
+    core.record_api_call('/joinGroupViaLink', 'error', 0.05, None)
+    core.record_job_wait('send', 2)
+    text = web_app.render_metrics()
+    assert len(series(text, 'wa_request_duration_seconds_bucket')) == 2 * (len(core.LATENCY_BUCKETS) + 1)
+    assert series(text, 'rq_job_wait_seconds_bucket{queue="send"')[:2] == [
+        'rq_job_wait_seconds_bucket{queue="send",le="1"} 0', 'rq_job_wait_seconds_bucket{queue="send",le="5"} 1']
+
+
+def test_no_calls_no_series(web_app, redis):
+    text = web_app.render_metrics()
+    assert '# TYPE wa_request_duration_seconds histogram' in text
+    assert not series(text, 'wa_request_duration_seconds_')
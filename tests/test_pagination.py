@@ -0,0 +1,39 @@
+import pytest
+
+import core
+
+
+@pytest.fixture
+def links(db, web_app):
+    for i in range(1, 8):
+        db.session.add(core.GroupLink(link=f'https://chat.whatsapp.com/{"Sale" if i % 2 else "Club"}{i}', active=True))
+    db.session.commit()
+    return db.session.execute(db.select(core.GroupLink.id).order_by(core.GroupLink.id)).scalars().all()
+
+
+def page(web_app, query_string, search_columns=(core.GroupLink.link,)):
+    with web_app.app.test_request_context(f'/links?{query_string}'):
+        rows, next_after = web_app.keyset_page(core.GroupLink, core.db.select(core.GroupLink), search_columns)
+    return [row.id for row in rows], next_after
+
+
+def test_pages_walk_down_from_the_newest(web_app, links):
+    assert page(web_app, 'per_page=3') == (links[:3:-1], links[4])
+    assert page(web_app, f'per_page=3&after={links[4]}') == (links[3:0:-1], links[1])
+    assert page(web_app, f'per_page=3&after={links[1]}') == ([links[0]], None)
+
+
+def test_exact_last_page_has_no_next(web_app, links):
+    assert page(web_app, 'per_page=7') == (links[::-1], None)
+
+
+def test_search_filters_before_paging(web_app, links):
+    sale = [link_id for i, link_id in enumerate(links, 1) if i % 2]
+    assert page(web_app, 'q=sale&per_page=2') == (sale[:1:-1], sale[2])
+    assert page(web_app, f'q=sale&per_page=2&after={sale[2]}') == (sale[1::-1], None)
+
+
+def test_page_size_is_clamped(web_app, links, monkeypatch):
+    monkeypatch.setattr(web_app, 'MAX_PAGE_SIZE', 2)
+    assert page(web_app, 'per_page=100')[0] == links[:4:-1]
+    assert page(web_app, 'per_page=0')[0] == links[-1:]
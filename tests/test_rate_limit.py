@@ -0,0 +1,78 @@
+import pytest
+
+import core
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch, redis):
+    pytest.importorskip('lupa')
+    clock = FakeClock()
+    monkeypatch.setattr(core.time, 'time', clock.time)
+    monkeypatch.setattr(core.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_burst_goes_out_right_away(clock):
+    limiter = core.RateLimiter('test', per_minute=60, burst=3)
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, 0]
+
+
+def test_callers_past_the_burst_wait_in_order(clock):
+    limiter = core.RateLimiter('test', per_minute=60, burst=1)
+    assert [limiter.reserve() for _ in range(4)] == [0, 1, 2, 3]
+
+
+def test_tokens_refill_with_time(clock):
+    limiter = core.RateLimiter('test', per_minute=120, burst=2)
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, 0.5]
+    clock.now += 1.5
+    # the waiting caller's token was paid back first
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, 0.5]
+
+
+def test_idle_bucket_fills_up_to_the_burst_only(clock):
+    limiter = core.RateLimiter('test', per_minute=60, burst=2)
+    limiter.reserve()
+    clock.now += 3600
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, 1]
+
+
+def test_buckets_are_separate(clock):
+    joins = core.RateLimiter('test:join', per_minute=60, burst=1)
+    sends = core.RateLimiter('test:send', per_minute=60, burst=1)
+    assert [joins.reserve(), sends.reserve(), joins.reserve()] == [0, 0, 1]
+
+
+def test_zero_rate_is_unlimited(clock, redis):
+    limiter = core.RateLimiter('test', per_minute=0)
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, 0]
+    assert not redis.exists(limiter.key)
+
+
+def test_acquire_sleeps_for_short_waits(clock):
+    limiter = core.RateLimiter('test', per_minute=60, burst=1)
+    assert limiter.acquire(max_wait=5) == 0
+    assert limiter.acquire(max_wait=5) == 0
+    assert clock.slept == [1]
+
+
+def test_acquire_hands_long_waits_back(clock):
+    limiter = core.RateLimiter('test', per_minute=6, burst=1)
+    limiter.acquire(max_wait=5)
+    assert limiter.acquire(max_wait=5) == 10
+    assert clock.slept == []
+    # the token stays taken, the next caller queues behind it
+    assert limiter.reserve() == 20
@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+
+import core
+from helpers import add_campaign, add_links, pending_ids
+
+
+def test_pending_link_chunks_skip_sent_links(db, monkeypatch):
+    monkeypatch.setattr(core, 'CAMPAIGN_CHUNK_SIZE', 2)
+    link_ids = add_links(db, 5)
+    campaign_id = add_campaign(db)
+    message_ids = core.create_campaign_messages(campaign_id, link_ids)
+    for link_id in (link_ids[0], link_ids[3]):
+        db.session.get(core.Message, message_ids[link_id]).message_send_succeeded = True
+    # a failed send is tried again
+    db.session.get(core.Message, message_ids[link_ids[1]]).message_send_succeeded = False
+    db.session.commit()
+
+    chunks = pending_ids(campaign_id, None, core.wa_sessions[0])
+    assert chunks == [[link_ids[1]], [link_ids[2]], [link_ids[4]]]
+
+
+def test_pending_link_chunks_skip_inactive_quarantined_and_backing_off_links(db):
+    link_ids = add_links(db, 2)
+    add_links(db, 1, 'Quarantined', quarantined_at=datetime.now())
+    add_links(db, 1, 'BackingOff', next_attempt_at=datetime.now() + timedelta(hours=1))
+    inactive = add_links(db, 1, 'Inactive')
+    db.session.get(core.GroupLink, inactive[0]).active = False
+    db.session.commit()
+    campaign_id = add_campaign(db)
+
+    assert pending_ids(campaign_id, None, core.wa_sessions[0]) == [link_ids]
+
+
+def test_pending_link_chunks_keep_to_id_ranges(db):
+    link_ids = add_links(db, 6)
+    campaign_id = add_campaign(db)
+    id_ranges = core.compact_ranges([link_ids[0], link_ids[1], link_ids[4]])
+
+    assert pending_ids(campaign_id, id_ranges, core.wa_sessions[0]) == [[link_ids[0], link_ids[1], link_ids[4]]]
+    assert pending_ids(campaign_id, [], core.wa_sessions[0]) == []
@@ -0,0 +1,61 @@
+import pytest
+
+import core
+from helpers import add_campaign, add_links, pending_ids
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    sessions = [core.WaSession('a', 'http://a'), core.WaSession('b', 'http://b')]
+    monkeypatch.setattr(core, 'wa_sessions', sessions)
+    monkeypatch.setattr(core, 'sessions_by_name', {session.name: session for session in sessions})
+    return sessions
+
+
+def placed(link_ids, **fields):
+    return [core.session_for(core.GroupLink(id=link_id, **fields)).name for link_id in link_ids]
+
+
+def test_new_groups_are_spread_over_the_sessions(sessions):
+    names = placed(range(1, 1001))
+    assert 400 < names.count('a') < 600
+
+
+def test_placement_is_stable(sessions):
+    assert placed(range(1, 101)) == placed(range(1, 101))
+
+
+def test_adding_a_session_only_moves_groups_to_it(sessions):
+    before = placed(range(1, 1001))
+    sessions.append(core.WaSession('c', 'http://c'))
+    after = placed(range(1, 1001))
+    moved = [(old, new) for old, new in zip(before, after) if old != new]
+    assert moved
+    assert all(new == 'c' for _, new in moved)
+
+
+def test_weights_skew_the_split(sessions):
+    sessions[0].weight = 3
+    names = placed(range(1, 1001))
+    assert 650 < names.count('a') < 850
+
+
+def test_weight_zero_session_gets_no_new_groups(sessions):
+    sessions[1].weight = 0
+    assert set(placed(range(1, 101))) == {'a'}
+
+
+def test_joined_groups_stay_with_their_session(sessions):
+    sessions[1].weight = 0
+    assert set(placed(range(1, 101), chat_id='1@g.us', wa_session='b')) == {'b'}
+    # groups joined before sessions were configured belong to the first one
+    assert set(placed(range(1, 101), chat_id='1@g.us')) == {'a'}
+
+
+def test_pending_link_chunks_split_links_between_sessions(db, sessions):
+    link_ids = add_links(db, 40)
+    campaign_id = add_campaign(db)
+
+    shards = [sum(pending_ids(campaign_id, None, wa_session), []) for wa_session in sessions]
+    assert all(shards)
+    assert sorted(shards[0] + shards[1]) == link_ids
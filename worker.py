@@ -0,0 +1,111 @@
+"""
+lightweight rq worker entrypoint. it builds a bare flask app around core.py, so workers load the models, the open-wa
+client and the job functions but never users.yaml, flask-login or the web routes.
+
+    python worker.py send join leave --processes 4
+
+everything is imported once, then the worker processes are forked from the warm parent, so extra processes and new
+replicas pull jobs within a second of starting. the parent starts a fresh process for any that dies and hands SIGTERM
+on to them, every one of them finishes its current job first. the flask cli works on this app as well, e.g.
+`flask --app worker schedule-jobs` or `flask --app worker rq scheduler`.
+"""
+import argparse
+import logging
+import os
+import signal
+import time
+
+from flask import Flask
+
+import core
+
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+core.init_app(app)
+
+# worker processes `python worker.py` forks per container. 0 means one per open-wa session for a worker that serves
+# the campaign queue, its shard jobs run for the whole campaign and every session needs a process of its own
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', 1))
+
+
+def run_worker(queues, burst: bool):
+    with app.app_context():
+        core.rq.get_worker(*queues).work(burst=burst, logging_level=core.LOG_LEVEL)
+
+
+def fork_worker(queues, burst: bool) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    # the child gets rq's own handlers once it starts working, until then the parent's must not run in it
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 1
+    try:
+        run_worker(queues, burst)
+        code = 0
+    except Exception:
+        logger.exception(" worker process failed")
+    finally:
+        core.flush_logs()
+        os._exit(code)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queues', nargs='*', default=list(core.QUEUES),
+                        help='queues in priority order, all of them by default')
+    parser.add_argument('--processes', type=int, default=WORKER_PROCESSES,
+                        help='worker processes to fork, 0 for one per session on the campaign queue')
+    parser.add_argument('--burst', action='store_true', help='exit once the queues are empty')
+    args = parser.parse_args(argv)
+    if 'campaign' in args.queues:
+        sessions = len(core.WA_SESSIONS)
+        args.processes = args.processes or sessions
+        if args.processes < sessions:
+            logger.warning(f" {args.processes} processes on the campaign queue for {sessions} sessions, the session "
+                           f"shards of a campaign run one after another unless CAMPAIGN_WORKER_REPLICAS makes up the "
+                           f"difference")
+    args.processes = max(1, args.processes)
+
+    # checked once here so the forked processes start with the schema in place. if the database is not reachable
+    # yet every process tries again before its first job
+    with app.app_context():
+        core.ensure_schema()
+    if args.processes <= 1:
+        run_worker(args.queues, args.burst)
+        return
+
+    children = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        # ctrl-c already reaches every process in the foreground group, passing it on again would be a cold shutdown
+        if signum == signal.SIGTERM:
+            for pid in children:
+                os.kill(pid, signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f" starting {args.processes} worker processes on {', '.join(args.queues)}")
+    while True:
+        while not stopping and len(children) < args.processes:
+            children[fork_worker(args.queues, args.burst)] = time.monotonic()
+        if not children:
+            break
+        pid, status = os.wait()
+        started = children.pop(pid, None)
+        # burst workers leave once the queues are empty and are not replaced
+        stopping = stopping or args.burst
+        if stopping or started is None:
+            continue
+        logger.warning(f" worker process {pid} exited with status {status}, starting a new one")
+        # one that keeps dying right away, e.g. with redis down, is restarted once a second at most
+        time.sleep(max(0.0, 1 - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    main()